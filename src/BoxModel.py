@@ -15,7 +15,7 @@ from os import path, mkdir
 from random import gauss
 from execo_engine import Engine, ParamSweeper, sweep, slugify, logger
 from execo.log import set_style
-from numpy import linspace, array, zeros, absolute
+from numpy import linspace, array, absolute, dot, diag
 from scipy.integrate import odeint
 import matplotlib.pyplot as plt 
 from pydot import Dot, Node, Edge
@@ -48,6 +48,7 @@ class BoxModel(Engine):
         self._Mass = array( [ box['Mass'] for box in self.Boxes.itervalues() ] )
         self._Flux = array( [ box.values() for box in self.Flux.values() ])
         self._Partcoeff = array( [ box.values() for box in self.Partcoeff.values() ])
+        self.compile_rate_matrix()
         
         f = open(outdir+'Delta.initial', 'w')
         for box, value in self.Boxes.iteritems():
@@ -63,23 +64,26 @@ class BoxModel(Engine):
             func = self.evol_ratio
         if outdir is None:
             outdir = self.result_dir
+        Dfun = self.jac_ratio if func == self.evol_ratio else None
         Ratio = [ ( delta/1e3+1e0)*self.standard for delta in Delta ] 
-        Ratio = odeint(func, Ratio, self.time)
+        Ratio = odeint(func, Ratio, self.time, Dfun = Dfun)
         Delta = ((Ratio/self.standard)-1.0)*1000;        
         self.plot_evolution(Delta, outdir = outdir)
         return Delta
     
+    def compile_rate_matrix(self):
+        """ Build the constant rate matrix so that d(ratio)/dt = Rate.ratio """
+        exchange = self._Flux*self._Partcoeff
+        self._Rate = (exchange.T - diag(exchange.sum(axis = 1)))/self._Mass[:, None]
+        return self._Rate
+    
     def evol_ratio(self, ratio, t):
         """ The evolution function that can be used for isotopic ratio evolution"""
-        rationew = zeros(ratio.size)
-        for ii in range(ratio.size):
-            outflux = 0;
-            influx = 0;
-            for jj in range(ratio.size):
-                outflux = outflux + self._Flux[ii][jj]/self._Mass[ii]*self._Partcoeff[ii][jj]*ratio[ii]
-                influx = influx + self._Flux[jj][ii]/self._Mass[ii]*self._Partcoeff[jj][ii]*ratio[jj]
-            rationew[ii]= influx - outflux
-        return rationew;
+        return dot(self._Rate, ratio)
+    
+    def jac_ratio(self, ratio, t):
+        """ The jacobian of evol_ratio, i.e. the constant rate matrix"""
+        return self._Rate
     
     def final_state(self, Delta_final, outdir = None):
         """ """
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+'''
+An engine that times the hot paths of the isotopic box model on synthetic
+networks and compares them to a stored baseline
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+import json
+import platform
+import gc
+from sys import exit, executable
+from subprocess import check_output
+from time import time as clock
+from fnmatch import fnmatch
+from os import path, makedirs
+from shutil import rmtree
+import numpy
+import scipy
+from IsotopicBoxModel import IsotopicBoxModel, ParamSweeper, sweep, \
+    logger, style, linspace, absolute
+from FeSimple import FeSimple
+from ZnCalibration import ZnCalibration
+
+# models replicated to build the synthetic networks, with the box through
+# which consecutive copies exchange
+models = {'fe': (FeSimple, 'plasma'), 'zn': (ZnCalibration, 'plasma')}
+
+# modules whose import is timed, in a new interpreter
+import_modules = {'core': 'IsotopicBoxModel', 'fe': 'FeSimple',
+                  'zn': 'ZnCalibration'}
+
+# plotting and graph modules that must not be loaded by these imports
+plotting_modules = ['matplotlib', 'networkx', 'pylab']
+
+# (phase, model, number of boxes, number of times, solver, sparse)
+cases = [('import', 'core', 0, 0, None, False),
+         ('import', 'fe', 0, 0, None, False),
+         ('import', 'zn', 0, 0, None, False),
+         ('evol_ratio', 'fe', 10, 0, None, False),
+         ('evol_ratio', 'zn', 10, 0, None, False),
+         ('evol_ratio', 'zn', 100, 0, None, False),
+         ('evol_ratio', 'zn', 1000, 0, None, False),
+         ('evol_ratio', 'zn', 1000, 0, None, True),
+         ('compute_evolution', 'fe', 10, 10000, 'odeint', False),
+         ('compute_evolution', 'zn', 10, 100, 'odeint', False),
+         ('compute_evolution', 'zn', 10, 10000, 'odeint', False),
+         ('compute_evolution', 'zn', 10, 1000000, 'odeint', False),
+         ('compute_evolution', 'zn', 10, 1000000, 'analytic', False),
+         ('compute_evolution', 'zn', 100, 10000, 'odeint', False),
+         ('compute_evolution', 'zn', 100, 10000, 'analytic', False),
+         ('compute_evolution', 'zn', 1000, 100, 'odeint', False),
+         ('compute_evolution', 'zn', 1000, 100, 'BDF', True),
+         ('state_io', 'fe', 10, 0, None, False),
+         ('state_io', 'zn', 10, 0, None, False),
+         ('state_io', 'zn', 1000, 0, None, False),
+         ('sweep', 'fe', 10, 1000, 'odeint', False),
+         ('sweep', 'zn', 10, 1000, 'odeint', False),
+         ('sweep', 'zn', 100, 1000, 'odeint', False)]
+
+# (model, number of boxes, number of times, solver, formulation, rtol and
+# atol) of the compute_evolution cases whose final Delta are compared to the
+# analytic solution, the tolerances being on the ratio or on the Delta in
+# per mil depending on the formulation
+accuracy_cases = [(model, 10, 10000, solver, formulation, tol)
+                  for model, solver in [('zn', 'odeint'), ('zn', 'BDF'),
+                                        ('fe', 'odeint')]
+                  for formulation, tol in [('ratio', 1.49012e-8),
+                                           ('ratio', 1e-10),
+                                           ('delta', 1e-4), ('delta', 1e-6),
+                                           ('delta', 1e-8)]]
+
+
+def replicate(Boxes, Flux, Partcoeff, n_box, link, link_flux=0.1):
+    """ Return the Boxes, Flux and Partcoeff dicts of as many copies of a
+    model as needed to have about n_box boxes, the link box of each copy
+    exchanging link_flux with the link box of the next one """
+    n_copy = max(1, int(round(float(n_box) / len(Boxes))))
+
+    def name(box, i_copy):
+        """ Name of a box in a copy """
+        return box + '_%03d' % i_copy
+
+    boxes, flux, partcoeff = {}, {}, {}
+    for i_copy in range(n_copy):
+        for box, values in Boxes.iteritems():
+            boxes[name(box, i_copy)] = dict(values)
+        for model, copy in [(Flux, flux), (Partcoeff, partcoeff)]:
+            for box_from, boxes_to in model.iteritems():
+                copy[name(box_from, i_copy)] = dict(
+                    (name(box_to, i_copy), value)
+                    for box_to, value in boxes_to.iteritems())
+    for i_copy in range(1, n_copy):
+        flux[name(link, i_copy - 1)][name(link, i_copy)] = link_flux
+        flux[name(link, i_copy)][name(link, i_copy - 1)] = link_flux
+    return boxes, flux, partcoeff
+
+
+class BoxModelBenchmark(IsotopicBoxModel):
+    """Engine that times the import of the engine modules, and the
+    evol_ratio, compute_evolution, initial_state and final_state, and sweep
+    phases on networks of copies of the FeSimple and ZnCalibration models,
+    and the accuracy of compute_evolution against its speed, writes the
+    timings to benchmark.json in the result directory and fails if a phase
+    is slower than the baseline by more than the threshold"""
+
+    def __init__(self):
+        """Add the benchmark options"""
+        super(BoxModelBenchmark, self).__init__()
+        self.args_parser.add_argument(
+            '--baseline', default=None,
+            help='baseline file, default benchmark_baseline.json in the '
+            'engine directory')
+        self.args_parser.add_argument(
+            '--save-baseline', action='store_true', default=False,
+            help='store the timings as the new baseline')
+        self.args_parser.add_argument(
+            '--threshold', type=float, default=0.25,
+            help='relative slow down of a phase that fails the benchmark')
+        self.args_parser.add_argument(
+            '--select', default='*',
+            help='only run the cases whose name matches this pattern, e.g. '
+            '"compute_evolution/zn/*"')
+        self.args_parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='number of timings of each case, the fastest is kept')
+        self.plot_mode = 'off'
+        # a timing runs a case as many times as needed to last this number
+        # of seconds
+        self.min_duration = 0.2
+        self._n_sweep = 0
+        # flux scales of the sweep cases
+        self.sweep_scales = [0.8, 0.9, 1.0, 1.1, 1.2]
+
+    def run(self):
+        """ Time the selected cases and compare them to the baseline """
+        baseline_file = self.args.baseline or \
+            path.join(self.engine_dir, 'benchmark_baseline.json')
+        results = {}
+        for case in cases:
+            name = self.case_name(*case)
+            if not fnmatch(name, self.args.select):
+                continue
+            timings = [self.time_case(i_repeat, *case)
+                       for i_repeat in range(self.args.repeat)]
+            phase, model, n_box, n_time, solver, sparse = case
+            results[name] = {'phase': phase, 'model': model, 'n_box': n_box,
+                             'n_time': n_time, 'solver': solver,
+                             'sparse': sparse, 'seconds': min(timings),
+                             'timings': timings}
+            logger.info('%s %s s', name.ljust(45),
+                        style.emph('%.4g' % min(timings)))
+        for case in accuracy_cases:
+            name = self.accuracy_name(*case)
+            if not fnmatch(name, self.args.select):
+                continue
+            results[name] = self.time_accuracy(*case)
+            logger.info('%s %s s, %s evaluations, error %s',
+                        name.ljust(45),
+                        style.emph('%.4g' % results[name]['seconds']),
+                        results[name]['n_rhs'],
+                        style.emph('%.2g' % results[name]['error']))
+        report = {'machine': {'platform': platform.platform(),
+                              'python': platform.python_version(),
+                              'numpy': numpy.__version__,
+                              'scipy': scipy.__version__},
+                  'results': results}
+        self.write_report(report, path.join(self.result_dir,
+                                            'benchmark.json'))
+        if self.args.save_baseline or not path.exists(baseline_file):
+            self.write_report(report, baseline_file)
+            logger.info('Baseline has been saved to %s',
+                        style.emph(baseline_file))
+            return
+        f = open(baseline_file)
+        baseline = json.load(f)['results']
+        f.close()
+        regressions = self.compare(results, baseline, self.args.threshold)
+        if regressions:
+            logger.error('Phases slower than %s by more than %d%%\n%s',
+                         baseline_file, 100 * self.args.threshold,
+                         '\n'.join(['%s %.4g s instead of %.4g s' %
+                                    (name.ljust(45), seconds, reference)
+                                    for name, seconds, reference
+                                    in regressions]))
+            exit(1)
+        logger.info('No phase is slower than %s', style.emph(baseline_file))
+
+    def case_name(self, phase, model, n_box, n_time, solver, sparse):
+        """ Return the name of a case, as in the benchmark files """
+        name = '%s/%s' % (phase, model)
+        if n_box:
+            name += '/%sbox' % n_box
+        if n_time:
+            name += '/%stime' % ('%.0e' % n_time).replace('e+0', 'e')
+        if solver is not None:
+            name += '/' + solver
+        if sparse:
+            name += '/sparse'
+        return name
+
+    def accuracy_name(self, model, n_box, n_time, solver, formulation,
+                      tol):
+        """ Return the name of an accuracy case, as in the benchmark files
+        """
+        return '%s/%s/%.3g' % (self.case_name('accuracy', model, n_box,
+                                               n_time, solver, False),
+                               formulation, tol)
+
+    def compare(self, results, baseline, threshold):
+        """ Return the (name, seconds, baseline seconds) of the cases
+        slower than their baseline by more than threshold """
+        regressions = []
+        for name, result in sorted(results.iteritems()):
+            if name not in baseline:
+                continue
+            reference = baseline[name]['seconds']
+            if result['seconds'] > reference * (1 + threshold):
+                regressions.append((name, result['seconds'], reference))
+        return regressions
+
+    def write_report(self, report, filename):
+        """ Write a report of timings as JSON """
+        f = open(filename, 'w')
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+
+    def setup_case(self, model, n_box, n_time, solver, sparse):
+        """ Set the synthetic network of a case as the model of the engine
+        """
+        engine, link = models[model]
+        # only the model definition is needed, not a whole engine
+        definition = engine.__new__(engine)
+        definition.parameters()
+        self.Boxes, self.Flux, self.Partcoeff = replicate(
+            definition.Boxes, definition.Flux, definition.Partcoeff, n_box,
+            link)
+        self.standard = definition.standard
+        self.time = linspace(0, 18250., max(n_time, 2))
+        self.output_time = None
+        self.solver = solver or 'odeint'
+        self.sparse = sparse
+        self.network = None
+        self.compile_arrays()
+        # flux scaled by the sweep combinations
+        self._diet_flux = [(box_from, box_to, flux)
+                           for box_from, box_to, flux in self.network.edges()
+                           if box_from.startswith('diet_')]
+
+    def set_combination(self, comb):
+        """Scale the flux from the diet boxes"""
+        for box_from, box_to, flux in self._diet_flux:
+            self.network.set_flux(box_from, box_to, flux * comb['scale'])
+
+    def time_case(self, i_repeat, phase, model, n_box, n_time, solver,
+                  sparse):
+        """ Return the duration of a run of a case, in seconds, averaged
+        over enough runs to last self.min_duration """
+        if phase == 'import':
+            return self.time_import(import_modules[model])
+        self.setup_case(model, n_box, n_time, solver, sparse)
+        outdir = path.join(self.result_dir,
+                           self.case_name(phase, model, n_box, n_time,
+                                          solver, sparse).replace('/', '_'))
+        if not path.exists(outdir):
+            makedirs(outdir)
+        return self.time_runs(phase, outdir)
+
+    def time_runs(self, phase, outdir):
+        """ Return the duration of a run of a phase on the model of the
+        engine, in seconds, averaged over enough runs to last
+        self.min_duration """
+        number = 1
+        while True:
+            elapsed = self.run_phase(phase, outdir, number)
+            if elapsed >= self.min_duration:
+                return elapsed / number
+            number = int(number * self.min_duration / max(elapsed, 1e-6)) + 1
+
+    def time_accuracy(self, model, n_box, n_time, solver, formulation, tol):
+        """ Return the result of an accuracy case: the fastest of the
+        timings of compute_evolution, the solver statistics and the largest
+        error of the final Delta with respect to the analytic solution,
+        boxes whose Delta derive beyond 1000 per mil being left out """
+        self.setup_case(model, n_box, n_time, solver, False)
+        outdir = path.join(self.result_dir, self.accuracy_name(
+            model, n_box, n_time, solver, formulation, tol).replace('/', '_'))
+        if not path.exists(outdir):
+            makedirs(outdir)
+        reference = self.compute_evolution(self.network.delta.copy(),
+                                           outdir=outdir,
+                                           solver='analytic')[-1]
+        settings = self.formulation, self.rtol, self.atol
+        self.formulation, self.rtol, self.atol = formulation, tol, tol
+        try:
+            timings = [self.time_runs('compute_evolution', outdir)
+                       for _ in range(self.args.repeat)]
+            final = self.compute_evolution(self.network.delta.copy(),
+                                           outdir=outdir)[-1]
+        finally:
+            self.formulation, self.rtol, self.atol = settings
+        kept = absolute(reference) < 1000
+        result = {'phase': 'accuracy', 'model': model, 'n_box': n_box,
+                  'n_time': n_time, 'solver': solver,
+                  'formulation': formulation, 'rtol': tol, 'atol': tol,
+                  'seconds': min(timings), 'timings': timings,
+                  'error': float(absolute(final - reference)[kept].max())}
+        for key in ['n_steps', 'n_rhs', 'n_jac', 'n_lu']:
+            result[key] = self.solver_stats.get(key)
+        return result
+
+    def time_import(self, module):
+        """ Return the duration of the import of a module in a new
+        interpreter, in seconds, averaged over enough imports to last
+        self.min_duration, and warn if it loads plotting modules """
+        script = '; '.join([
+            'import sys', 'from time import time', 'start = time()',
+            'import ' + module, 'print time() - start',
+            'print " ".join(name for name in %r if name in sys.modules)' %
+            plotting_modules])
+        elapsed, number = 0., 0
+        while elapsed < self.min_duration:
+            output = check_output([executable, '-c', script],
+                                  cwd=self.engine_dir).split('\n')
+            elapsed += float(output[0])
+            number += 1
+        if output[1].strip():
+            logger.warning('Importing %s loads %s', style.emph(module),
+                           output[1].strip())
+        return elapsed / number
+
+    def run_phase(self, phase, outdir, number):
+        """ Return the duration of number runs of a phase on the model of
+        the engine, in seconds """
+        ratio = (self.network.delta / 1e3 + 1e0) * self.standard
+        if phase == 'sweep':
+            # the combinations are written in the case directory, a new
+            # sweeper is needed for each run and removed once timed
+            result_dir, self.result_dir = self.result_dir, outdir
+            sweep_dirs, sweepers = [], []
+            for _ in range(number):
+                self._n_sweep += 1
+                sweep_dirs.append(path.join(outdir,
+                                            'sweeps_%d' % self._n_sweep))
+                sweepers.append(ParamSweeper(
+                    sweep_dirs[-1], sweep({'scale': self.sweep_scales})))
+        gc.collect()
+        start = clock()
+        try:
+            for i_run in range(number):
+                if phase == 'evol_ratio':
+                    self.evol_ratio(ratio, 0e0)
+                elif phase == 'compute_evolution':
+                    self.compute_evolution(self.network.delta.copy(),
+                                           outdir=outdir)
+                elif phase == 'state_io':
+                    Delta = self.initial_state(outdir=outdir)
+                    self.final_state(Delta, outdir=outdir)
+                elif phase == 'sweep':
+                    self.run_sweeper(sweepers[i_run])
+                else:
+                    raise ValueError('Unknown phase ' + phase)
+            elapsed = clock() - start
+        finally:
+            if phase == 'sweep':
+                self.result_dir = result_dir
+                for sweep_dir in sweep_dirs:
+                    rmtree(sweep_dir, ignore_errors=True)
+        return elapsed
+
+
+if __name__ == "__main__":
+    engine = BoxModelBenchmark()
+    engine.start()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+The compiled form of the Boxes, Flux and Partcoeff dicts of a box model
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+from numpy import array, zeros, ones, asarray, nonzero, concatenate, diag
+from scipy.sparse import coo_matrix, diags
+
+
+class BoxNetwork(object):
+    """Boxes of a model with a fixed name to index map, their mass and
+    Delta, the flux and partition coefficients between them and the rate
+    matrix of the ratio evolution system, d(ratio)/dt = Rate . ratio
+
+    Single entries can be changed in place with set_mass, set_delta,
+    set_flux and set_partcoeff, or from partial dicts with update. A dense
+    rate matrix is patched at each change, in place, so that it has to be
+    copied to be kept. A sparse one is built again from the flux arrays the
+    next time it is requested.
+
+    With sparse, only the non zero flux are stored, missing flux and
+    partition coefficients being 0 and 1, and the rate matrix is a
+    scipy.sparse CSR matrix."""
+
+    def __init__(self, Boxes, Flux, Partcoeff, sparse=False):
+        """Compile the dicts of a model, the order of the boxes is the one
+        of Boxes and does not change afterwards"""
+        self.boxes = list(Boxes.keys())
+        self.index = dict((box, i) for i, box in enumerate(self.boxes))
+        self.mass = array([Boxes[box]['Mass'] for box in self.boxes],
+                          dtype=float)
+        self.delta = array([Boxes[box]['Delta'] for box in self.boxes],
+                           dtype=float)
+        self.sparse = sparse
+        n_box = len(self.boxes)
+        if sparse:
+            # flux arrays, with the position of each (from, to) pair and the
+            # partition coefficients of the pairs that have no flux yet
+            self._edges = {}
+            self._rows = zeros(0, dtype=int)
+            self._cols = zeros(0, dtype=int)
+            self._flux = zeros(0)
+            self._partcoeff = zeros(0)
+            self._pending = {}
+        else:
+            self.flux = zeros((n_box, n_box))
+            self.partcoeff = ones((n_box, n_box))
+        self._rate = None
+        self.update(Flux=Flux, Partcoeff=Partcoeff)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def rate_matrix(self):
+        """Return the rate matrix, Rate[j][i] = Flux[i][j] * Partcoeff[i][j]
+        / Mass[j] for the influx and the total outflux of each box on the
+        diagonal"""
+        if self._rate is None:
+            if self.sparse:
+                self._rate = self._build_sparse()
+            else:
+                exchange = self.flux * self.partcoeff
+                self._outflux = exchange.sum(axis=1)
+                self._rate = (exchange.T - diag(self._outflux)) / \
+                    self.mass[:, None]
+        return self._rate
+
+    def _build_sparse(self):
+        """Build the CSR rate matrix from the flux arrays"""
+        n_box = len(self.boxes)
+        exchange = coo_matrix((self._flux * self._partcoeff,
+                               (self._rows, self._cols)),
+                              shape=(n_box, n_box)).tocsr()
+        outflux = asarray(exchange.sum(axis=1)).ravel()
+        rate = (diags(1e0 / self.mass, 0) *
+                (exchange.T - diags(outflux, 0))).tocsr()
+        rate.eliminate_zeros()
+        return rate
+
+    def get_flux(self, box_from, box_to):
+        """Return the flux from box_from to box_to"""
+        i, j = self.index[box_from], self.index[box_to]
+        if not self.sparse:
+            return self.flux[i, j]
+        k = self._edges.get((i, j))
+        return 0e0 if k is None else self._flux[k]
+
+    def get_partcoeff(self, box_from, box_to):
+        """Return the partition coefficient from box_from to box_to"""
+        i, j = self.index[box_from], self.index[box_to]
+        if not self.sparse:
+            return self.partcoeff[i, j]
+        k = self._edges.get((i, j))
+        return self._pending.get((i, j), 1e0) if k is None \
+            else self._partcoeff[k]
+
+    def set_mass(self, box, mass):
+        """Change the mass of a box"""
+        j = self.index[box]
+        self.mass[j] = mass
+        if self._rate is None:
+            return
+        if self.sparse:
+            self._rate = None
+            return
+        # the influx of box j, as in rate_matrix
+        row = self.flux[:, j] * self.partcoeff[:, j]
+        row[j] -= self._outflux[j]
+        self._rate[j] = row / mass
+
+    def set_delta(self, box, delta):
+        """Change the Delta of a box"""
+        self.delta[self.index[box]] = delta
+
+    def set_flux(self, box_from, box_to, flux):
+        """Change the flux from box_from to box_to"""
+        i, j = self.index[box_from], self.index[box_to]
+        if self.sparse:
+            k = self._edges.get((i, j))
+            if k is None:
+                if flux == 0:
+                    return
+                k = self._add_edge(i, j)
+            self._flux[k] = flux
+            self._rate = None
+            return
+        self.flux[i, j] = flux
+        self._patch(i, j)
+
+    def set_partcoeff(self, box_from, box_to, partcoeff):
+        """Change the partition coefficient from box_from to box_to"""
+        i, j = self.index[box_from], self.index[box_to]
+        if self.sparse:
+            k = self._edges.get((i, j))
+            if k is None:
+                self._pending[(i, j)] = partcoeff
+            else:
+                self._partcoeff[k] = partcoeff
+                self._rate = None
+            return
+        self.partcoeff[i, j] = partcoeff
+        self._patch(i, j)
+
+    def _patch(self, i, j):
+        """Update the dense rate matrix after a change of the exchange from
+        box i to box j, which only affects Rate[j][i] and Rate[i][i]"""
+        if self._rate is None:
+            return
+        exchange = self.flux[i] * self.partcoeff[i]
+        self._outflux[i] = exchange.sum()
+        self._rate[j, i] = exchange[j] / self.mass[j]
+        self._rate[i, i] = (exchange[i] - self._outflux[i]) / self.mass[i]
+
+    def _add_edge(self, i, j):
+        """Append a (from, to) pair to the flux arrays of a sparse network
+        """
+        k = len(self._flux)
+        self._edges[(i, j)] = k
+        self._rows = concatenate((self._rows, [i]))
+        self._cols = concatenate((self._cols, [j]))
+        self._flux = concatenate((self._flux, [0e0]))
+        self._partcoeff = concatenate((self._partcoeff,
+                                       [self._pending.pop((i, j), 1e0)]))
+        return k
+
+    def get(self, parameter):
+        """Return the value of a parameter, ('Flux', box_from, box_to),
+        ('Partcoeff', box_from, box_to), ('Mass', box) or ('Delta', box)"""
+        kind = parameter[0]
+        if kind == 'Flux':
+            return self.get_flux(*parameter[1:])
+        if kind == 'Partcoeff':
+            return self.get_partcoeff(*parameter[1:])
+        if kind == 'Mass':
+            return self.mass[self.index[parameter[1]]]
+        if kind == 'Delta':
+            return self.delta[self.index[parameter[1]]]
+        raise ValueError('Unknown parameter ' + str(parameter))
+
+    def set(self, parameter, value):
+        """Change the value of a parameter, see get"""
+        setters = {'Flux': self.set_flux, 'Partcoeff': self.set_partcoeff,
+                   'Mass': self.set_mass, 'Delta': self.set_delta}
+        if parameter[0] not in setters:
+            raise ValueError('Unknown parameter ' + str(parameter))
+        setters[parameter[0]](*(tuple(parameter[1:]) + (value,)))
+
+    def update(self, Boxes=None, Flux=None, Partcoeff=None):
+        """Change the entries of the network given by dicts shaped like the
+        model ones, possibly partial, only the entries that differ are
+        changed"""
+        if Boxes is not None:
+            for box, values in Boxes.iteritems():
+                i = self.index[box]
+                if 'Mass' in values and values['Mass'] != self.mass[i]:
+                    self.set_mass(box, values['Mass'])
+                if 'Delta' in values:
+                    self.delta[i] = values['Delta']
+        for values, get, set_value in [
+                (Flux, self.get_flux, self.set_flux),
+                (Partcoeff, self.get_partcoeff, self.set_partcoeff)]:
+            if values is None:
+                continue
+            for box_from, boxes_to in values.iteritems():
+                for box_to, value in boxes_to.iteritems():
+                    if value != get(box_from, box_to):
+                        set_value(box_from, box_to, value)
+
+    def edges(self):
+        """Return the (box_from, box_to, flux) of the non zero flux"""
+        if self.sparse:
+            keep = nonzero(self._flux)[0]
+            rows, cols, flux = self._rows[keep], self._cols[keep], \
+                self._flux[keep]
+        else:
+            rows, cols = nonzero(self.flux)
+            flux = self.flux[rows, cols]
+        return [(self.boxes[i], self.boxes[j], value)
+                for i, j, value in zip(rows, cols, flux)]
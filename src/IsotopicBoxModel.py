@@ -11,20 +11,111 @@ This tools released under the GNU Public
 License, version 3 or later.
 '''
 from pprint import pformat
-from string import Template
-from os import path, mkdir, listdir
+from os import path, mkdir, makedirs, rename
+from shutil import rmtree
+from hashlib import sha1
+from multiprocessing import Pool
+from Queue import Queue, Empty
+from traceback import format_exc
+from cPickle import dumps
+from functools import wraps
+from contextlib import contextmanager
+from itertools import chain
+from numbers import Number
 from random import gauss
 from execo import configuration
 from execo_engine import Engine, ParamSweeper, sweep, slugify, logger
 from execo.log import style
-from numpy import linspace, array, zeros, absolute
-from scipy.integrate import odeint
-import matplotlib.pyplot as plt
-import gc
-import networkx as nx
+from numpy import linspace, array, zeros, absolute, dot, diff, exp, \
+    allclose, empty, identity, tensordot, nan, ix_, einsum, log2, ceil, \
+    concatenate, asarray, nonzero, ones, full, where, nanmin, nanmax, \
+    isnan, savez, save, load, ascontiguousarray, memmap, dtype as dtype_
+from numpy.lib.format import write_array_header_1_0, dtype_to_descr
+from numpy.linalg import solve, LinAlgError
+from numpy.random import RandomState
+import scipy.integrate
+from scipy.integrate import odeint, ode
+from scipy.sparse import csc_matrix, issparse
+from scipy.sparse.linalg import expm_multiply, spsolve, splu
+try:
+    from scipy.integrate import solve_ivp
+except ImportError:
+    # scipy < 1.0, only odeint and the analytic solver are available
+    solve_ivp = None
+from scipy.linalg import expm, expm_frechet, lu_factor, lu_solve
+from BoxNetwork import BoxNetwork
+from ResultStore import ResultStore
+from ResultCube import ResultCube, check_slugs
+from RunningStats import RunningStats
+from PhaseTimer import PhaseTimer
+# matplotlib and networkx are only imported by the methods that draw, so
+# that headless engines and workers do not load them
 
 configuration['color_styles']['comb'] = 'on_cyan', 'bold'
 
+# solve_ivp methods, the implicit ones use the sparse rate matrix as jacobian
+ivp_solvers = {'BDF': 'sparse', 'Radau': 'sparse', 'LSODA': 'dense',
+               'RK45': None, 'RK23': None}
+
+# engine inherited by the worker processes of run_sweeper and monte_carlo
+# when they are forked, so that its time grid and arrays are never pickled
+_sweep_engine = None
+
+
+def _run_combination(comb):
+    """ Worker function of run_sweeper, returning the error of a failed
+    combination, or a RuntimeError if it cannot be pickled, and its
+    traceback """
+    try:
+        return comb, _sweep_engine.run_combination(comb), None
+    except Exception as error:
+        trace = format_exc()
+        try:
+            dumps(error)
+        except Exception:
+            error = RuntimeError(str(error))
+        return comb, None, (error, trace)
+
+
+def _monte_carlo_batch(args):
+    """ Worker function of monte_carlo """
+    return _sweep_engine.monte_carlo_batch(*args)
+
+
+@contextmanager
+def _no_phase():
+    """ Phase of an engine that is not profiled """
+    yield
+
+
+def profiled(name):
+    """ Decorator timing an engine method as phase name when the engine
+    profile is set, see IsotopicBoxModel.phase """
+    def decorate(method):
+        @wraps(method)
+        def timed(self, *args, **kwargs):
+            if not self.profile:
+                return method(self, *args, **kwargs)
+            with self.phase(name):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
+
+
+def batch_expm(matrices, order=18):
+    """ Matrix exponential of a stack of matrices (..., n, n), computed by
+    scaling and squaring of a Taylor series """
+    norm = absolute(matrices).sum(axis=-2).max()
+    n_square = max(0, int(ceil(log2(norm / 0.5)))) if norm > 0 else 0
+    scaled = matrices / 2. ** n_square
+    expo = identity(matrices.shape[-1]) + scaled / order
+    for k in range(order - 1, 0, -1):
+        expo = identity(matrices.shape[-1]) + \
+            einsum('...ij,...jk->...ik', scaled, expo) / k
+    for _ in range(n_square):
+        expo = einsum('...ij,...jk->...ik', expo, expo)
+    return expo
+
 
 class IsotopicBoxModel(Engine):
     """This is the main engine that is used to created custom isotopic models
@@ -33,88 +124,1576 @@ class IsotopicBoxModel(Engine):
         """Initialize the execo engine"""
         super(IsotopicBoxModel, self).__init__()
         self.init_plots()
+        # 'odeint', 'analytic', 'BDF', 'Radau', 'LSODA', 'RK45', 'RK23' or
+        # 'auto', see compute_evolution, or 'steady' to get the final state
+        # directly, see compute_final_delta
+        self.solver = 'odeint'
+        # relative and absolute tolerances of the numerical solvers, the
+        # odeint defaults
+        self.rtol = 1.49012e-8
+        self.atol = 1.49012e-8
+        # variables integrated by the numerical solvers, 'ratio' or 'delta'
+        # for the Delta in per mil, on which the tolerances then apply, see
+        # evol_delta
+        self.formulation = 'ratio'
+        # stiffness ratio above which 'auto' uses an implicit solver
+        self.stiff_ratio = 1e3
+        # bytes of the (box, box) propagators the analytic solver may hold,
+        # larger rate matrices use the Krylov action, see evol_analytic
+        self.analytic_memory = 2 ** 28
+        # compile a sparse rate matrix, for networks of many boxes with few
+        # flux, see compile_arrays
+        self.sparse = False
+        # compiled Boxes, Flux and Partcoeff, see compile_network
+        self.network = None
+        self._compiled = None
+        # sweep parameters on which the rate matrix and the initial Delta
+        # depend affinely, 'auto' to detect them or None, see rate_matrices
+        self.affine_parameters = None
+        # affine model of each group of combinations and digest of its
+        # base state, see rate_matrices
+        self._affine = {}
+        # distributions of the flux and partition coefficients used by
+        # monte_carlo, {('Flux' or 'Partcoeff', box_from, box_to):
+        # (numpy.random distribution, parameters...)}
+        self.uncertainties = {}
+        # number of processes used by run_sweeper
+        self.n_workers = 1
+        # 'text' for Delta.initial and Delta.final files in each combination
+        # directory, 'store' for a single ResultStore file in result_dir
+        self.results_backend = 'text'
+        # also keep the evolution of the boxes in the store
+        self.store_trajectory = False
+        self.store = None
+        # 'on' to draw the plots of each combination, 'off' to skip them or
+        # 'deferred' to draw them at the end of run_sweeper, only for the
+        # combinations selected by plot_filter(comb) (all if None)
+        self.plot_mode = 'on'
+        self.plot_filter = None
+        self.plot_queue = []
+        # output of compute_evolution, see its docstring
+        self.output_time = None
+        self.output_dtype = None
+        # maximum number of odeint steps between two output times, 0 for
+        # the odeint default
+        self.mxstep = 0
+        # stop compute_evolution once the Delta of every reservoir box is
+        # within equilibrium_tol per mil of its steady state, None to
+        # integrate over the whole time, see iter_to_equilibrium
+        self.equilibrium_tol = None
+        # time at which each box reached equilibrium in the last evolution
+        self.equilibrium_time = None
+        # float64 Delta of all the boxes at self.time[-1] in the last
+        # evolution, whatever its output time and dtype
+        self.Delta_final = None
+        # save the state of compute_evolution every checkpoint_window
+        # output times and resume interrupted evolutions, None not to, see
+        # iter_checkpointed
+        self.checkpoint_window = None
+        # write the evolution to evolution.npy as it is computed and return
+        # it memory mapped, see collect_evolution
+        self.stream_evolution = False
+        # number of output times converted and written at once
+        self.evolution_chunk = 1024
+        # record the wall and CPU time of the engine phases and the solver
+        # statistics of every combination in profile.jsonl, see phase
+        self.profile = False
+        self.timer = None
+        # statistics of the solver in the last evolution
+        self.solver_stats = None
         logger.info(style.log_header('\n\n                 Welcome to the ' +
                                      'human isotopic Box Model\n'))
         logger.debug(pformat(self.__dict__))
 
+    def run(self):
+        """ Log the profile summary, execo runs it after the run method
+        of the derived engine """
+        if not self.profile:
+            return
+        self.record_profile()
+        # with several workers, the combinations are recorded by the
+        # workers and this process may not have timed anything itself
+        timer = self.profile_timer()
+        logger.info(style.log_header('Profile') + ' of %s\n%s',
+                    style.emph(timer.filename), timer.summary())
+
+    def profile_timer(self):
+        """ Return the PhaseTimer of the profile.jsonl file of the result
+        directory, created on the first call once self.profile is set """
+        if self.timer is None:
+            self.timer = PhaseTimer(path.join(self.result_dir,
+                                              'profile.jsonl'))
+        return self.timer
+
+    def phase(self, name):
+        """ Context manager timing a phase of the engine when
+        self.profile is set
+
+        The wall and CPU time of the phases, without the time of the phases
+        nested in them, are recorded for each combination in the
+        profile.jsonl file of the result directory, see PhaseTimer and
+        record_profile """
+        if not self.profile:
+            return _no_phase()
+        return self.profile_timer().phase(name)
+
+    def record_profile(self, comb=None):
+        """ Append the phases timed since the last record and the
+        statistics of the last solver to the profile log, as the record of
+        comb or of the work outside of the combinations if None """
+        if self.timer is None or not self.timer.phases:
+            return
+        self.timer.record(comb=comb, slug=None if comb is None
+                          else slugify(comb), solver=self.solver_stats)
+
+    @profiled('initial_state')
     def initial_state(self, outdir=None):
-        """ Convert the dict given from parameters to Numpy array """
+        """ Compile the model, see compile_arrays, and return the boxes
+        initial Delta """
+        with self.phase('compile'):
+            self.compile_arrays()
+        network = self.network
         logger.info(style.log_header('Initial boxes configuration\n') +
                     ''.ljust(8) +
                     ''.join([style.emph(box.rjust(10))
-                             for box in self.Boxes.iterkeys()]) +
+                             for box in network.boxes]) +
                     style.object_repr('\n' + 'Delta'.ljust(8)) +
-                    ''.join([str(box['Delta']).rjust(10)
-                             for box in self.Boxes.itervalues()]) +
+                    ''.join([str(delta).rjust(10)
+                             for delta in network.delta]) +
                     style.object_repr('\n' + 'Mass'.ljust(8)) +
-                    ''.join([str(box['Mass']).rjust(10)
-                             for box in self.Boxes.itervalues()])
+                    ''.join([str(mass).rjust(10)
+                             for mass in network.mass])
                     )
         if outdir is None:
             outdir = self.result_dir + '/'
-        self.plot_state(self.Boxes.keys(),
-                        array([box['Delta']
-                               for box in self.Boxes.itervalues()]),
-                        name='_initial', outdir=outdir)
-
-        self._Mass = array([box['Mass']
-                            for box in self.Boxes.itervalues()])
-        self._Flux = array([box.values()
-                            for box in self.Flux.values()])
-        self._Partcoeff = array([box.values()
-                                 for box in self.Partcoeff.values()])
-
-        f = open(outdir + '/Delta.initial', 'w')
-        for box, value in self.Boxes.iteritems():
-            f.write(box + ' ' + str(value['Delta']) + '\n')
-        f.close()
-        return [box['Delta'] for box in self.Boxes.itervalues()]
+        if self.plot_mode == 'on':
+            self.plot_state(network.boxes, network.delta, name='_initial',
+                            outdir=outdir)
 
-    def compute_evolution(self, Delta, func=None, outdir=None):
-        """ """
-        logger.info(style.log_header('Computing evolution'))
+        if self.results_backend == 'text':
+            f = open(outdir + '/Delta.initial', 'w')
+            for box, delta in zip(network.boxes, network.delta):
+                f.write(box + ' ' + str(delta) + '\n')
+            f.close()
+        return network.delta.copy()
+
+    @profiled('compute_evolution')
+    def compute_evolution(self, Delta, func=None, outdir=None, solver=None,
+                          time=None, boxes=None, dtype=None):
+        """ Compute the boxes Delta from self.time[0], starting from the
+        given Delta. solver defaults to self.solver and is one of:
+        - 'odeint', numerical integration of func with LSODA from odepack
+        - 'analytic', exact solution through the matrix exponential of the
+          rate matrix
+        - 'BDF', 'Radau', 'LSODA', 'RK45' or 'RK23', the solve_ivp method,
+          the implicit ones being given the sparse rate matrix as jacobian
+        - 'auto', 'BDF' or 'RK45' depending on the stiffness of the system,
+          see choose_solver
+        The numerical solvers use self.rtol and self.atol.
+
+        The solver chooses its own steps, and only the output time (default
+        self.output_time, or self.time if None) and boxes (default all) are
+        returned, as a (time, box) array of dtype (default
+        self.output_dtype, or float64 if None)
+
+        If self.equilibrium_tol is set, the integration stops once the
+        reservoir boxes are within it of their steady state and the
+        remaining output times are given the steady state, see
+        iter_to_equilibrium. If
+        self.checkpoint_window is set, its state is saved in outdir as it
+        goes and an interrupted evolution starts again from its last
+        checkpoint, see iter_checkpointed. If self.stream_evolution is set,
+        the Delta are written to outdir as they are computed and returned
+        as a read only memory mapped array, see collect_evolution
+
+        The integration always goes on to self.time[-1], and the Delta of
+        all the boxes at this time are kept in float64 in self.Delta_final.
+        The statistics of the solver are kept in self.solver_stats. """
+        if solver is None:
+            solver = self.solver
         if func is None:
             func = self.evol_ratio
+        if solver == 'auto':
+            solver = self.choose_solver()
+        logger.info(style.log_header('Computing evolution') + ' using ' +
+                    style.emph(solver))
         if outdir is None:
             outdir = self.result_dir
-        Ratio = [(delta / 1e3 + 1e0) * self.standard for delta in Delta]
-        Ratio = odeint(func, Ratio, self.time)
-        Delta = ((Ratio / self.standard) - 1.0) * 1000
-        self.plot_evolution(Delta, outdir=outdir)
+        time = self.get_output_time(time)
+        # the initial state is given at self.time[0] and the final one at
+        # self.time[-1]
+        solve_time = time if time[0] == self.time[0] else \
+            concatenate(([self.time[0]], time))
+        n_solve = len(solve_time)
+        if time[-1] != self.time[-1]:
+            solve_time = concatenate((solve_time, [self.time[-1]]))
+        Ratio = array([(delta / 1e3 + 1e0) * self.standard
+                       for delta in Delta])
+        columns = slice(None) if boxes is None else \
+            [self.network.index[box] for box in boxes]
+        if dtype is None:
+            dtype = self.output_dtype
+        self.equilibrium_time = None
+        self.solver_stats = None
+        self.Delta_final = None
+        if self.equilibrium_tol is None and not self.checkpoint_window and \
+                not self.stream_evolution:
+            with self.phase('solver'):
+                Ratio = self.integrate(func, Ratio, solve_time, solver)
+            self.Delta_final = ((Ratio[-1] / self.standard) - 1.0) * 1000
+            Ratio = Ratio[n_solve - len(time):n_solve, columns]
+            Delta = (((Ratio / self.standard) - 1.0) * 1000).astype(dtype)
+        else:
+            rows = self.iter_checkpointed(func, Ratio, solve_time, solver,
+                                          outdir)
+            if self.equilibrium_tol is not None:
+                rows = self.iter_to_equilibrium(rows, Ratio, solve_time)
+            rows = self.iter_final(rows, Ratio, n_solve)
+            # the solver steps as the rows are collected
+            with self.phase('solver'):
+                Delta = self.collect_evolution(rows, Ratio, n_solve,
+                                               n_solve - len(time), columns,
+                                               dtype, outdir)
+            if self.equilibrium_tol is not None and \
+                    self.results_backend == 'text':
+                self.write_equilibrium(outdir)
+            if self.checkpoint_window:
+                self.clear_checkpoint(outdir)
+        if self.plot_mode == 'on':
+            self.plot_evolution(Delta, outdir=outdir, time=time, boxes=boxes)
         return Delta
 
+    def iter_final(self, rows, ratio, n_time):
+        """ Yield the n_time - 1 ratio following the initial ratio, and set
+        self.Delta_final from the last one yielded by rows, the one of
+        self.time[-1] """
+        for k, ratio in enumerate(rows, 1):
+            if k < n_time:
+                yield ratio
+        self.Delta_final = ((ratio / self.standard) - 1.0) * 1000
+
+    def collect_evolution(self, rows, ratio, n_time, skip, columns, dtype,
+                          outdir=None):
+        """ Gather the initial ratio and the n_time - 1 following ones
+        yielded by rows into the (time, box) Delta of the columns boxes,
+        the first skip times being left out
+
+        The ratio are converted by chunks of self.evolution_chunk output
+        times. With self.stream_evolution, each chunk is appended to the
+        evolution.npy file of outdir and the Delta are returned as a read
+        only memory mapped array of this file, so that the evolution is
+        never held in memory. """
+        n_box = ratio.size if isinstance(columns, slice) else len(columns)
+        shape = (n_time - skip, n_box)
+        dtype = dtype_(dtype)
+        if not self.stream_evolution:
+            Delta = empty(shape, dtype=dtype)
+
+            def fill(k, block):
+                """ Copy the Delta of a chunk in the evolution """
+                start = max(k - skip, 0)
+                Delta[start:start + len(block)] = block
+
+            self._convert_rows(rows, ratio, skip, columns, dtype, fill)
+            return Delta
+        if outdir is None:
+            outdir = self.result_dir
+        if not path.exists(outdir):
+            makedirs(outdir)
+        filename = path.join(outdir, 'evolution.npy')
+        # written under another name and renamed once complete, so that a
+        # failed evolution does not leave a truncated file
+        f = open(filename + '.tmp', 'wb')
+        try:
+            write_array_header_1_0(f, {'descr': dtype_to_descr(dtype),
+                                       'fortran_order': False,
+                                       'shape': shape})
+            self._convert_rows(rows, ratio, skip, columns, dtype,
+                               lambda k, block: f.write(block.tobytes()))
+        finally:
+            f.close()
+        rename(filename + '.tmp', filename)
+        logger.info('Evolution has been written to ' + style.emph(filename))
+        return load(filename, mmap_mode='r')
+
+    def _convert_rows(self, rows, ratio, skip, columns, dtype, write):
+        """ Convert the initial ratio and the ones yielded by rows by
+        chunks of self.evolution_chunk output times, and call write with
+        the output time of the first ratio of each chunk and its Delta """
+        chunk, k = [ratio], 0
+        for ratio in rows:
+            if len(chunk) == self.evolution_chunk:
+                write(k, self._convert_chunk(chunk, k, skip, columns, dtype))
+                k += len(chunk)
+                chunk = []
+            chunk.append(ratio)
+        write(k, self._convert_chunk(chunk, k, skip, columns, dtype))
+
+    def _convert_chunk(self, chunk, k, skip, columns, dtype):
+        """ Return the Delta of the columns boxes of a chunk of ratio
+        starting at output time k, without the first skip times """
+        Ratio = array(chunk[max(skip - k, 0):])[:, columns]
+        return (((Ratio / self.standard) - 1.0) * 1000).astype(dtype)
+
+    def integrate(self, func, ratio, time, solver):
+        """ Return the ratio of the boxes on time, (time, box), given the
+        ratio at time[0], see compute_evolution for the solvers """
+        if solver == 'analytic':
+            if func != self.evol_ratio:
+                raise ValueError('analytic solver can only be used with '
+                                 'the linear evol_ratio system')
+            self.solver_stats = {'solver': solver,
+                                 'n_output': len(time) - 1}
+            return self.evol_analytic(ratio, time)
+        if func == self.evol_ratio and self.formulation == 'delta':
+            Delta = self.integrate(self.evol_delta,
+                                   self.ratio_to_delta(ratio), time, solver)
+            return self.delta_to_ratio(Delta)
+        if solver == 'odeint':
+            # the exact jacobian is only known for the linear system
+            Dfun = self.jac_ratio if func in self.linear_funcs() else None
+            Ratio, info = odeint(func, ratio, time, Dfun=Dfun,
+                                 mxstep=self.mxstep, rtol=self.rtol,
+                                 atol=self.atol, full_output=True)
+            self.solver_stats = self.odeint_stats(info)
+            return Ratio
+        if solver in ivp_solvers:
+            return self.evol_ivp(func, ratio, time, solver)
+        raise ValueError('Unknown solver ' + str(solver))
+
+    def odeint_stats(self, info):
+        """ Return the statistics of odeint from its full_output infodict:
+        the numbers of steps, of function and jacobian evaluations and of
+        switches between the Adams (non stiff) and BDF (stiff) methods, the
+        smallest and largest steps and the last method """
+        if len(info['nst']) == 0:
+            return {'solver': 'odeint'}
+        steps = info['hu'][info['hu'] > 0]
+        return {'solver': 'odeint', 'n_steps': int(info['nst'][-1]),
+                'n_rhs': int(info['nfe'][-1]), 'n_jac': int(info['nje'][-1]),
+                'n_switches': int((diff(info['mused']) != 0).sum()),
+                'step_min': float(steps.min()) if len(steps) else None,
+                'step_max': float(steps.max()) if len(steps) else None,
+                'method': {1: 'adams', 2: 'bdf'}.get(int(info['mused'][-1]))}
+
+    def iter_to_equilibrium(self, rows, ratio, time):
+        """ Yield the ratio of rows, the ratio at each time after time[0] of
+        an evolution starting from ratio, up to the first output time at
+        which the Delta of every reservoir box is within
+        self.equilibrium_tol per mil of its steady state, and then the
+        steady state for the remaining output times
+
+        The steady state is the one of compute_steady_state, given the
+        current ratio of the source boxes. After the stop, the sources go
+        on decaying with their own outflux, the reservoirs follow their
+        steady state and the sinks keep accumulating their influx, so that
+        the final Delta stay within the tolerance of a full integration for
+        the reservoirs.
+
+        Once all the times are yielded, the time from which each box stayed
+        within the tolerance of its steady state is kept in
+        self.equilibrium_time, nan for the boxes that never converged and
+        for the sources and sinks. """
+        sources, sinks, reservoirs = self.box_roles(self._Rate)
+        steady = self.steady_solver(sources, reservoirs)
+        tol = self.equilibrium_tol * self.standard / 1e3
+        since = full(ratio.size, nan)
+        stop = None
+        for k, ratio in enumerate(chain([ratio], rows)):
+            if k > 0:
+                yield ratio
+            converged = absolute(ratio[reservoirs] -
+                                 steady(ratio[sources])) < tol
+            since[reservoirs] = where(
+                converged, where(isnan(since[reservoirs]), time[k],
+                                 since[reservoirs]), nan)
+            if converged.all():
+                stop = k
+                break
+        if stop is not None:
+            decay = self._Rate.diagonal()[sources]
+            sink_rate = self._Rate[sinks]
+            previous = ratio
+            for k in range(stop + 1, len(time)):
+                step = time[k] - time[k - 1]
+                ratio = previous.copy()
+                ratio[sources] = previous[sources] * exp(decay * step)
+                ratio[reservoirs] = steady(ratio[sources])
+                # influx of the sinks, trapezoidal over the output step
+                ratio[sinks] += step / 2. * (sink_rate.dot(previous) +
+                                             sink_rate.dot(ratio))
+                previous = ratio
+                yield ratio
+        self.equilibrium_time = since
+        boxes = self.network.boxes
+        if stop is None:
+            logger.warning('Boxes %s are not at equilibrium at the end of '
+                           'the evolution',
+                           ', '.join([style.emph(boxes[i]) for i in reservoirs
+                                      if isnan(since[i])]))
+        else:
+            logger.info('Equilibrium reached, integration stopped at %s '
+                        'instead of %s', style.emph(time[stop]), time[-1])
+        logger.info('Time to equilibrium\n%s',
+                    '\n'.join([boxes[i].ljust(10) + str(since[i])
+                               for i in reservoirs]))
+
+    def steady_solver(self, sources, reservoirs):
+        """ Return the function giving the steady ratio of the reservoir
+        boxes from the ratio of the source boxes, the reservoir block of the
+        rate matrix being factorized once """
+        if not reservoirs:
+            return lambda source_ratio: zeros(0)
+        try:
+            if issparse(self._Rate):
+                Rate = self._Rate.tocsc()
+                solve_block = splu(
+                    Rate[reservoirs][:, reservoirs].tocsc()).solve
+                coupling = Rate[reservoirs][:, sources].tocsr()
+            else:
+                lu = lu_factor(self._Rate[ix_(reservoirs, reservoirs)])
+                if (lu[0].diagonal() == 0).any():
+                    raise LinAlgError
+                solve_block = lambda rhs: lu_solve(lu, rhs)
+                coupling = self._Rate[ix_(reservoirs, sources)]
+        except (LinAlgError, RuntimeError):
+            raise ValueError('Reservoir boxes have no steady state, check '
+                             'that they are all connected to a source box')
+        return lambda source_ratio: solve_block(-coupling.dot(source_ratio))
+
+    def write_equilibrium(self, outdir=None):
+        """ Write the time to equilibrium of the boxes, see
+        iter_to_equilibrium """
+        if outdir is None:
+            outdir = self.result_dir
+        f = open(outdir + '/Delta.equilibrium', 'w')
+        for box, time in zip(self.network.boxes, self.equilibrium_time):
+            f.write(box + ' ' + str(time) + '\n')
+        f.close()
+
+    def ivp_jacobian(self, func, method):
+        """ Return the jacobian arguments of a solve_ivp method, the rate
+        matrix for the linear system and the implicit methods """
+        if func in self.linear_funcs() and ivp_solvers[method] == 'sparse':
+            return {'jac': csc_matrix(self._Rate)}
+        if func in self.linear_funcs() and ivp_solvers[method] == 'dense':
+            return {'jac': lambda t, ratio: self.jac_ratio(ratio, t)}
+        return {}
+
+    def evol_ivp(self, func, ratio, time, method):
+        """ Integrate func with a solve_ivp method, returning the ratio on
+        time as odeint does """
+        if solve_ivp is None:
+            raise ValueError('solver ' + method + ' requires scipy >= 1.0')
+        result = solve_ivp(lambda t, ratio: func(ratio, t),
+                           (time[0], time[-1]), ratio, method=method,
+                           t_eval=time, rtol=self.rtol, atol=self.atol,
+                           **self.ivp_jacobian(func, method))
+        if not result.success:
+            raise RuntimeError(method + ' solver failed: ' + result.message)
+        self.solver_stats = {'solver': method, 'n_rhs': int(result.nfev),
+                             'n_jac': int(result.njev),
+                             'n_lu': int(result.nlu)}
+        logger.debug('%s: %s function and %s jacobian evaluations, '
+                     '%s LU decompositions', method, result.nfev,
+                     result.njev, result.nlu)
+        return result.y.T
+
+    def iter_evolution(self, func, ratio, time, solver):
+        """ Yield the ratio of the boxes at each time after time[0], given
+        the ratio at time[0], so that the integration can be stopped at any
+        output time
+
+        The same solver goes on from one output time to the next without
+        being restarted: odeint is replaced by the LSODA integrator of
+        scipy.integrate.ode, the solve_ivp methods are stepped and
+        interpolated on the output times and the analytic solution applies
+        the propagator of each output step. self.solver_stats is updated
+        at each output time. """
+        if solver == 'analytic':
+            if func != self.evol_ratio:
+                raise ValueError('analytic solver can only be used with '
+                                 'the linear evol_ratio system')
+            steps = diff(time)
+            if len(steps) and allclose(steps, steps[0]):
+                steps[:] = steps[0]
+            props = {}
+            self.solver_stats = stats = {'solver': solver, 'n_output': 0}
+            for step in steps:
+                if issparse(self._Rate):
+                    ratio = expm_multiply(self._Rate * step, ratio)
+                else:
+                    if step not in props:
+                        props[step] = expm(self._Rate * step)
+                    ratio = dot(props[step], ratio)
+                stats['n_output'] += 1
+                yield ratio
+        elif func == self.evol_ratio and self.formulation == 'delta':
+            for delta in self.iter_evolution(self.evol_delta,
+                                             self.ratio_to_delta(ratio),
+                                             time, solver):
+                yield self.delta_to_ratio(delta)
+        elif solver == 'odeint':
+            jac = (lambda t, ratio: self.jac_ratio(ratio, t)) \
+                if func in self.linear_funcs() else None
+            integrator = ode(lambda t, ratio: func(ratio, t), jac)
+            integrator.set_integrator('lsoda', rtol=self.rtol,
+                                      atol=self.atol,
+                                      nsteps=self.mxstep or 500)
+            integrator.set_initial_value(ratio, time[0])
+            self.solver_stats = stats = {'solver': solver, 'n_switches': 0}
+            # work arrays of LSODA, as in the odeint infodict
+            iwork, rwork = integrator._integrator.iwork, \
+                integrator._integrator.rwork
+            method = None
+            for t in time[1:]:
+                ratio = integrator.integrate(t)
+                if not integrator.successful():
+                    raise RuntimeError('odeint solver failed at %s' % t)
+                if method is not None and iwork[18] != method:
+                    stats['n_switches'] += 1
+                method = int(iwork[18])
+                stats.update({'n_steps': int(iwork[10]),
+                              'n_rhs': int(iwork[11]),
+                              'n_jac': int(iwork[12]),
+                              'method': {1: 'adams', 2: 'bdf'}.get(method)})
+                if rwork[10] > 0:
+                    stats['step_min'] = min(stats.get('step_min', rwork[10]),
+                                            float(rwork[10]))
+                    stats['step_max'] = max(stats.get('step_max', 0.),
+                                            float(rwork[10]))
+                yield ratio
+        elif solver in ivp_solvers:
+            if solve_ivp is None:
+                raise ValueError('solver ' + solver +
+                                 ' requires scipy >= 1.0')
+            integrator = getattr(scipy.integrate, solver)(
+                lambda t, ratio: func(ratio, t), time[0], ratio, time[-1],
+                rtol=self.rtol, atol=self.atol,
+                **self.ivp_jacobian(func, solver))
+            self.solver_stats = stats = {'solver': solver, 'n_steps': 0}
+            k = 1
+            while k < len(time):
+                while integrator.t < time[k]:
+                    message = integrator.step()
+                    if integrator.status == 'failed':
+                        raise RuntimeError(solver + ' solver failed: ' +
+                                           str(message))
+                    stats['n_steps'] += 1
+                stats.update({'n_rhs': int(integrator.nfev),
+                              'n_jac': int(integrator.njev),
+                              'n_lu': int(integrator.nlu)})
+                interpolant = integrator.dense_output()
+                while k < len(time) and time[k] <= integrator.t:
+                    yield interpolant(time[k])
+                    k += 1
+        else:
+            raise ValueError('Unknown solver ' + str(solver))
+
+    def iter_checkpointed(self, func, ratio, time, solver, outdir=None):
+        """ Yield the ratio of the boxes at each time after time[0] as
+        iter_evolution does, saving them every self.checkpoint_window
+        output times in the evolution.checkpoint directory of outdir
+
+        If this directory holds a checkpoint of the same evolution, see
+        checkpoint_key, its ratio are yielded first and the solver starts
+        again from the last of them, which is the whole state of the ratio
+        system. Each window is written to its own file before the state
+        file that lists it, so that a checkpoint only writes the new output
+        times and an interrupted write leaves the previous checkpoint. """
+        if not self.checkpoint_window:
+            for ratio in self.iter_evolution(func, ratio, time, solver):
+                yield ratio
+            return
+        if outdir is None:
+            outdir = self.result_dir
+        checkpoint = path.join(outdir, 'evolution.checkpoint')
+        key = self.checkpoint_key(func, ratio, time, solver)
+        n_done, n_window = 1, 0
+        if path.exists(path.join(checkpoint, 'state.npz')):
+            state = load(path.join(checkpoint, 'state.npz'))
+            if str(state['key']) == key:
+                n_done, n_window = int(state['n_done']), \
+                    int(state['n_window'])
+                logger.info('Resuming evolution from %s at %s',
+                            style.emph(checkpoint), time[n_done - 1])
+                for i_window in range(n_window):
+                    for ratio in load(path.join(checkpoint,
+                                                'window_%06d.npy' %
+                                                i_window)):
+                        yield ratio
+            else:
+                logger.warning('%s is the checkpoint of another evolution, '
+                               'starting over', style.emph(checkpoint))
+                rmtree(checkpoint)
+        if not path.exists(checkpoint):
+            makedirs(checkpoint)
+        window = []
+        for k, ratio in enumerate(self.iter_evolution(func, ratio,
+                                                      time[n_done - 1:],
+                                                      solver), n_done):
+            window.append(ratio)
+            if len(window) == self.checkpoint_window or k == len(time) - 1:
+                self._write_checkpoint(checkpoint, 'window_%06d.npy' %
+                                       n_window, save, array(window))
+                n_window += 1
+                self._write_checkpoint(checkpoint, 'state.npz', savez,
+                                       key=key, n_done=k + 1,
+                                       n_window=n_window)
+                window = []
+            yield ratio
+
+    def _write_checkpoint(self, checkpoint, name, writer, *args, **kwargs):
+        """ Write a file of a checkpoint under another name and rename it,
+        so that it is either complete or missing """
+        tmp = path.join(checkpoint, name + '.tmp')
+        f = open(tmp, 'wb')
+        writer(f, *args, **kwargs)
+        f.close()
+        rename(tmp, path.join(checkpoint, name))
+
+    def checkpoint_key(self, func, ratio, time, solver):
+        """ Return a digest of the system, initial ratio, output time and
+        solver of an evolution, so that a checkpoint is only resumed by the
+        same evolution """
+        digest = sha1(' '.join([solver, func.__name__, self.formulation,
+                                repr(self.rtol), repr(self.atol)]))
+        if issparse(self._Rate):
+            Rate = self._Rate.tocsr()
+            arrays = [Rate.data, Rate.indices, Rate.indptr]
+        else:
+            arrays = [self._Rate]
+        for values in arrays + [ratio, time]:
+            digest.update(ascontiguousarray(values).tobytes())
+        return digest.hexdigest()
+
+    def clear_checkpoint(self, outdir=None):
+        """ Remove the checkpoint of a finished evolution """
+        if outdir is None:
+            outdir = self.result_dir
+        checkpoint = path.join(outdir, 'evolution.checkpoint')
+        if path.exists(checkpoint):
+            rmtree(checkpoint)
+
+    def choose_solver(self):
+        """ Return 'BDF' if the system is stiff, 'RK45' otherwise, or
+        'odeint' if solve_ivp is not available
+
+        The stiffness ratio is estimated from the outflux rates of the boxes
+        (the diagonal of the rate matrix): fastest rate over slowest rate,
+        the latter being at least the inverse of the integration span."""
+        if solve_ivp is None:
+            return 'odeint'
+        rates = absolute(self._Rate.diagonal())
+        rates = rates[rates > 0]
+        if len(rates) == 0:
+            return 'RK45'
+        span = self.time[-1] - self.time[0]
+        ratio = rates.max() / max(rates.min(), 1. / span)
+        logger.debug('Stiffness ratio %s', ratio)
+        return 'BDF' if ratio > self.stiff_ratio else 'RK45'
+
+    def get_output_time(self, time=None):
+        """ Return the given output time, or self.output_time, or self.time
+        """
+        if time is None:
+            time = self.output_time if self.output_time is not None \
+                else self.time
+        return asarray(time)
+
+    def compile_network(self):
+        """ Compile the Boxes, Flux and Partcoeff dicts into self.network, a
+        BoxNetwork with a fixed box order
+
+        The network is kept from one call to the next as long as it has the
+        same boxes: dicts that have been replaced since the last call are
+        read again and only their changed entries are patched, so that a
+        combination can also be set by changing self.network directly
+        without touching the dicts. Entries changed in place in the dicts
+        are not seen, the dicts must be replaced. """
+        network = self.network
+        if network is None or network.sparse != self.sparse or \
+                sorted(network.boxes) != sorted(self.Boxes.keys()):
+            self.network = BoxNetwork(self.Boxes, self.Flux, self.Partcoeff,
+                                      sparse=self.sparse)
+        else:
+            network.update(*[model if model is not compiled else None
+                             for model, compiled in
+                             zip([self.Boxes, self.Flux, self.Partcoeff],
+                                 self._compiled)])
+        self._compiled = (self.Boxes, self.Flux, self.Partcoeff)
+        return self.network
+
+    def compile_arrays(self):
+        """ Compile the network and its rate matrix, so that
+        d(ratio)/dt = Rate . ratio, see BoxNetwork
+
+        If self.sparse is set, only the non zero flux are read, missing flux
+        and partition coefficients being 0 and 1, and the rate matrix is a
+        scipy.sparse CSR matrix """
+        network = self.compile_network()
+        self._Mass = network.mass
+        self._Rate = network.rate_matrix()
+        self._dense_rate = None
+        return self._Rate
+
     def evol_ratio(self, ratio, t):
         """ The evolution function that is used for isotopic ratio evolution"""
-        rationew = zeros(ratio.size)
-        for ii in range(ratio.size):
-            outflux = 0
-            influx = 0
-            for jj in range(ratio.size):
-                outflux = outflux + self._Flux[ii][jj] / self._Mass[ii] * \
-                    self._Partcoeff[ii][jj] * ratio[ii]
-                influx = influx + self._Flux[jj][ii] / self._Mass[ii] * \
-                    self._Partcoeff[jj][ii] * ratio[jj]
-            rationew[ii] = influx - outflux
-        return rationew
+        return self._Rate.dot(ratio)
+
+    def evol_delta(self, delta, t):
+        """ The evolution function of the Delta of the boxes, in per mil,
+        equivalent to evol_ratio: d(Delta)/dt = Rate . Delta + 1e3 Rate . 1
+
+        Delta are of order 1 while the ratio only differ from the standard
+        in their 5th to 7th digit, so that the tolerances of the solvers
+        apply to the signal and not to the standard. The jacobian is the
+        rate matrix, as for evol_ratio. The source term 1e3 Rate . 1 is set
+        by ratio_to_delta. """
+        return self._Rate.dot(delta) + self._delta_source
+
+    def ratio_to_delta(self, ratio):
+        """ Return the Delta of the boxes ratio and set the source term of
+        evol_delta from the current rate matrix """
+        self._delta_source = 1e3 * self._Rate.dot(ones(len(ratio)))
+        return ((ratio / self.standard) - 1.0) * 1000
+
+    def delta_to_ratio(self, delta):
+        """ Return the ratio of the boxes Delta """
+        return (delta / 1e3 + 1e0) * self.standard
+
+    def linear_funcs(self):
+        """ Return the evolution functions whose jacobian is the rate
+        matrix """
+        return self.evol_ratio, self.evol_delta
+
+    def jac_ratio(self, ratio, t):
+        """ The jacobian of evol_ratio and evol_delta, which is the constant
+        rate matrix"""
+        if issparse(self._Rate):
+            # odepack only takes dense jacobians
+            if self._dense_rate is None:
+                self._dense_rate = self._Rate.toarray()
+            return self._dense_rate
+        return self._Rate
+
+    def evol_analytic(self, ratio, time, block=1024):
+        """ Exact solution of d(ratio)/dt = Rate . ratio on the time grid,
+        given the ratio at time[0]
+
+        On a regular grid, the propagator expm(Rate * dt) and its first
+        powers are computed once and the trajectory is evaluated by blocks
+        of stacked matrix products. Irregular grids use one matrix
+        exponential per distinct time step. The propagators held at once
+        are bounded by self.analytic_memory bytes: fewer powers are
+        computed, and a sparse rate matrix, or one whose propagators do not
+        fit, uses the Krylov action of the exponential on the ratio
+        instead."""
+        n_box = ratio.size
+        if len(time) < 2:
+            return ratio[None, :].repeat(len(time), axis=0)
+        steps = diff(time)
+        # the powers come with the propagator and its last power
+        n_props = self.analytic_memory // (8 * n_box ** 2) - 2
+        if issparse(self._Rate) or n_props < 1:
+            if allclose(steps, steps[0]):
+                return expm_multiply(self._Rate, ratio, start=0,
+                                     stop=time[-1] - time[0],
+                                     num=len(time), endpoint=True)
+            Ratio = empty((len(time), n_box))
+            Ratio[0] = ratio
+            for k, step in enumerate(steps):
+                Ratio[k + 1] = expm_multiply(self._Rate * step, Ratio[k])
+            return Ratio
+        if allclose(steps, steps[0]):
+            prop = expm(self._Rate * steps[0])
+            block = min(block, len(time), n_props)
+            powers = empty((block, n_box, n_box))
+            powers[0] = identity(n_box)
+            for k in range(1, block):
+                powers[k] = dot(prop, powers[k - 1])
+            jump = dot(prop, powers[-1])
+            starts = empty(((len(time) - 1) // block + 1, n_box))
+            starts[0] = ratio
+            for i_block in range(1, len(starts)):
+                starts[i_block] = dot(jump, starts[i_block - 1])
+            Ratio = tensordot(starts, powers, axes=([1], [2]))
+            Ratio = Ratio.reshape(-1, n_box)[:len(time)]
+        else:
+            Ratio = empty((len(time), n_box))
+            Ratio[0] = ratio
+            props = {}
+            for k, step in enumerate(steps):
+                prop = props.get(step)
+                if prop is None:
+                    prop = expm(self._Rate * step)
+                    if len(props) < n_props:
+                        props[step] = prop
+                Ratio[k + 1] = dot(prop, Ratio[k])
+        return Ratio
+
+    @profiled('steady_state')
+    def compute_steady_state(self, Delta):
+        """ Compute the equilibrium Delta of the boxes by solving the linear
+        balance system Rate . ratio = 0, without time integration
+
+        Source boxes (no influx, e.g. diet) are held at their given Delta,
+        which assumes their mass is large enough for them not to evolve
+        during self.time. Sink boxes (no outflux, e.g. urine or feces) never
+        equilibrate: they are flagged in the log and their Delta is nan."""
+        logger.info(style.log_header('Computing steady state'))
+        boxes = self.network.boxes
+        sources, sinks, _ = self.box_roles(self._Rate)
+        if sinks:
+            logger.warning('Boxes ' +
+                           ', '.join([style.emph(boxes[i]) for i in sinks]) +
+                           ' have no outflux and never equilibrate')
+        for i in sources:
+            if -self._Rate[i, i] * (self.time[-1] - self.time[0]) > 1e-3:
+                logger.warning('Source box %s evolves during the run, '
+                               'steady state holds it at its initial Delta',
+                               style.emph(boxes[i]))
+        Ratio = array([(delta / 1e3 + 1e0) * self.standard
+                       for delta in Delta])
+        if issparse(self._Rate):
+            Ratio = self.sparse_steady_ratio(self._Rate, Ratio)
+        else:
+            Ratio = self.steady_ratio(self._Rate[None], Ratio[None])[0]
+        return ((Ratio / self.standard) - 1.0) * 1000
+
+    def box_roles(self, Rate):
+        """ Split the boxes indices of a dense or sparse rate matrix into
+        sources (no influx), sinks (no outflux) and reservoirs """
+        outflux = -Rate.diagonal()
+        influx = asarray(abs(Rate).sum(axis=1)).ravel() - absolute(outflux)
+        is_source = influx == 0
+        is_sink = (outflux == 0) & ~is_source
+        return list(nonzero(is_source)[0]), list(nonzero(is_sink)[0]), \
+            list(nonzero(~is_source & ~is_sink)[0])
+
+    def sparse_steady_ratio(self, Rate, Ratio):
+        """ Solve the balance system for a sparse rate matrix and initial
+        ratio, see steady_ratio """
+        sources, sinks, reservoirs = self.box_roles(Rate)
+        Rate = Rate.tocsc()
+        Ratio = array(Ratio, dtype=float)
+        rhs = -Rate[reservoirs][:, sources].dot(Ratio[sources])
+        Ratio[reservoirs] = spsolve(Rate[reservoirs][:, reservoirs], rhs)
+        Ratio[sinks] = nan
+        return Ratio
+
+    def steady_ratio(self, Rates, Ratios):
+        """ Solve the balance system for a stack of rate matrices
+        (comb, box, box) and initial ratios (comb, box), the combinations
+        sharing the same boxes roles being solved together """
+        Ratios = array(Ratios, dtype=float)
+        groups = {}
+        for i_comb, Rate in enumerate(Rates):
+            roles = tuple(map(tuple, self.box_roles(Rate)))
+            groups.setdefault(roles, []).append(i_comb)
+        for (sources, sinks, reservoirs), combs in groups.iteritems():
+            sources, sinks, reservoirs = map(list,
+                                             (sources, sinks, reservoirs))
+            rates = Rates[combs]
+            try:
+                Ratios[ix_(combs, reservoirs)] = solve(
+                    rates[ix_(range(len(combs)), reservoirs, reservoirs)],
+                    -einsum('cij,cj->ci',
+                            rates[ix_(range(len(combs)), reservoirs,
+                                      sources)],
+                            Ratios[ix_(combs, sources)]))
+            except LinAlgError:
+                raise ValueError('Reservoir boxes have no steady state, '
+                                 'check that they are all connected to a '
+                                 'source box')
+            Ratios[ix_(combs, sinks)] = nan
+        return Ratios
+
+    def set_combination(self, comb):
+        """ Set the Boxes, Flux and Partcoeff of a sweep combination, must
+        be implemented by the engines that use run_sweeper or
+        compute_batch """
+        raise NotImplementedError('%s must define set_combination to use '
+                                  'run_sweeper/compute_batch' %
+                                  type(self).__name__)
+
+    def check_set_combination(self):
+        """ Raise the error of set_combination if the engine does not
+        define it, before any combination is run """
+        if type(self).set_combination.__func__ is \
+                IsotopicBoxModel.set_combination.__func__:
+            self.set_combination(None)
 
+    def run_combination(self, comb):
+        """ Compute the model of a sweep combination, write its text results
+        in the combination directory and return its boxes, initial Delta,
+        final Delta, its evolution if it has to be stored and its time to
+        equilibrium if it is detected, see iter_to_equilibrium
+
+        With self.profile, the timing of its phases is recorded, see
+        record_profile """
+        if not self.profile:
+            return self._compute_combination(comb)
+        self.solver_stats = None
+        with self.phase('run_combination'):
+            results = self._compute_combination(comb)
+        self.record_profile(comb)
+        return results
+
+    def _compute_combination(self, comb):
+        """ Body of run_combination """
+        comb_dir = self.result_dir + '/' + slugify(comb)
+        if self.results_backend == 'text' or self.plot_mode == 'on':
+            try:
+                mkdir(comb_dir)
+            except:
+                pass
+        with self.phase('set_combination'):
+            self.set_combination(comb)
+        Delta_initial = self.initial_state(outdir=comb_dir)
+        if self.solver == 'steady':
+            Delta = None
+            Delta_final = self.compute_steady_state(Delta_initial)
+        else:
+            Delta = self.compute_evolution(Delta_initial, outdir=comb_dir)
+            Delta_final = self.Delta_final
+        self.final_state(Delta_final, outdir=comb_dir)
+        if not self.store_trajectory:
+            Delta = None
+        elif isinstance(Delta, memmap):
+            # a streamed evolution is stored as its file
+            Delta = path.relpath(Delta.filename, self.result_dir)
+        equilibrium = None if self.solver == 'steady' \
+            else self.equilibrium_time
+        return self.network.boxes, Delta_initial, Delta_final, Delta, \
+            equilibrium
+
+    def run_sweeper(self, sweeper, n_workers=None):
+        """ Run all the remaining combinations of a ParamSweeper, on
+        n_workers processes (default self.n_workers)
+
+        Combinations are handed one at a time to the first idle worker, so
+        that slow combinations do not hold back the others, and at most
+        n_workers combinations are in progress at any time. They are marked
+        done by this process as soon as they are finished. Whatever the
+        number of workers, the first failed combination aborts the sweep
+        with its error, the combinations in progress being left to be done
+        again. Deferred plots are drawn at the end.
+
+        With the text backend or plots, which write to the directory of
+        each combination, the sweep does not start if two combinations
+        share a directory, see check_slugs. """
+        if n_workers is None:
+            n_workers = self.n_workers
+        self.check_set_combination()
+        if self.results_backend == 'text' or self.plot_mode != 'off':
+            # refuse to start rather than overwrite the results of the
+            # combinations sharing a directory
+            check_slugs(sweeper.get_sweeps())
+        if self.results_backend == 'store' and self.store is None:
+            self.store = ResultStore(path.join(self.result_dir,
+                                               'results.store'))
+        # the work done so far is not part of the combinations
+        self.record_profile()
+        total_comb = len(sweeper.get_remaining())
+        logger.info('Engine will treat %s models on %s process(es)',
+                    style.emph(total_comb), style.emph(n_workers))
+        i_comb = 0
+        if n_workers == 1:
+            while len(sweeper.get_remaining()) > 0:
+                i_comb += 1
+                comb = sweeper.get_next()
+                logger.info(style.comb('Combination %s/%s' %
+                                       (i_comb, total_comb)) + '\n%s',
+                            pformat(comb))
+                self.combination_done(sweeper, comb,
+                                      self.run_combination(comb))
+                logger.info('Combination done\n')
+        else:
+            self._run_pool(sweeper, n_workers, total_comb)
+        if self.store is not None:
+            self.store.flush()
+        if self.plot_mode == 'deferred':
+            self.render_plots(self.plot_queue)
+            self.plot_queue = []
+
+    def _run_pool(self, sweeper, n_workers, total_comb):
+        """ Parallel loop of run_sweeper """
+        global _sweep_engine
+        _sweep_engine = self
+        pool = Pool(n_workers)
+        finished = Queue()
+        n_running = 0
+        i_comb = 0
+        try:
+            while True:
+                while n_running < n_workers:
+                    comb = sweeper.get_next()
+                    if comb is None:
+                        break
+                    i_comb += 1
+                    logger.info(style.comb('Combination %s/%s' %
+                                           (i_comb, total_comb)) + '\n%s',
+                                pformat(comb))
+                    pool.apply_async(_run_combination, (comb,),
+                                     callback=finished.put)
+                    n_running += 1
+                if n_running == 0:
+                    break
+                try:
+                    # a timeout keeps the wait interruptible
+                    comb, results, error = finished.get(timeout=1)
+                except Empty:
+                    continue
+                n_running -= 1
+                if error is not None:
+                    # as in the serial loop, the pool being terminated
+                    logger.error('Combination failed\n%s\n%s',
+                                 pformat(comb), error[1])
+                    raise error[0]
+                self.combination_done(sweeper, comb, results)
+                logger.info('Combination done\n%s', pformat(comb))
+        finally:
+            pool.terminate()
+            pool.join()
+            _sweep_engine = None
+
+    def combination_done(self, sweeper, comb, results):
+        """ Store the results returned by run_combination, mark the
+        combination done and queue its plots if they are deferred """
+        if self.store is not None:
+            boxes, Delta_initial, Delta_final, Delta, equilibrium = results
+            self.store.append(comb, slugify(comb), boxes, Delta_initial,
+                              Delta_final, Delta, self.get_output_time(),
+                              equilibrium)
+        sweeper.done(comb)
+        if self.plot_mode == 'deferred' and \
+                (self.plot_filter is None or self.plot_filter(comb)):
+            self.plot_queue.append(comb)
+
+    def render_plots(self, combs):
+        """ Draw the state and evolution plots of the given combinations in
+        their directories, without writing their results """
+        logger.info(style.log_header('Drawing plots') + ' of %s '
+                    'combinations', style.emph(len(combs)))
+        plot_mode, self.plot_mode = self.plot_mode, 'on'
+        try:
+            for comb in combs:
+                comb_dir = self.result_dir + '/' + slugify(comb)
+                try:
+                    mkdir(comb_dir)
+                except:
+                    pass
+                self.set_combination(comb)
+                self.compile_arrays()
+                network = self.network
+                Delta = network.delta.copy()
+                self.plot_state(network.boxes, Delta, name='_initial',
+                                outdir=comb_dir)
+                Delta = self.compute_final_delta(Delta, outdir=comb_dir)
+                self.plot_state(network.boxes, Delta, name='_final',
+                                outdir=comb_dir)
+        finally:
+            self.plot_mode = plot_mode
+
+    def comb_state(self, comb):
+        """ Set a combination and return copies of its dense rate matrix and
+        initial Delta """
+        self.set_combination(comb)
+        Rate = self.compile_arrays()
+        # the dense rate matrix is patched in place by the next set
+        return Rate.toarray() if issparse(Rate) else Rate.copy(), \
+            self.network.delta.copy()
+
+    def rate_matrices(self, combs):
+        """ Return the rate matrices (comb, box, box) and initial Delta
+        (comb, box) of a list of combinations
+
+        If self.affine_parameters is set, the combinations that only differ
+        in the values of these parameters are gathered and, for each
+        group, the rate matrix and initial Delta are built once with their
+        derivatives with respect to the affine parameters, see
+        affine_model. The states of the group are then a tensor
+        contraction instead of one set_combination per combination. """
+        if self.affine_parameters is None:
+            Rates, Deltas = zip(*[self.comb_state(comb) for comb in combs])
+            return array(Rates), array(Deltas)
+        parameters = self.affine_parameters
+        if parameters == 'auto':
+            parameters = self.detect_affine(combs)
+        others = sorted(set(combs[0].keys()) - set(parameters))
+        groups = {}
+        for i_comb, comb in enumerate(combs):
+            key = tuple((name, comb[name]) for name in others)
+            groups.setdefault(key, []).append(i_comb)
+        n_box = None
+        for key, group in groups.iteritems():
+            cache_key = (tuple(parameters), key)
+            # the affine model of a group is kept as long as the compiled
+            # state of its base combination is the same
+            digest, model = self._affine.get(cache_key, (None, None))
+            if model is not None and \
+                    self.state_digest(*self.comb_state(model[0])) != digest:
+                logger.info('Model has changed, computing the affine '
+                            'model again')
+                model = None
+            if model is None:
+                model = self.affine_model(combs[group[0]], parameters)
+                self._affine[cache_key] = (self.state_digest(*model[1:3]),
+                                           model)
+            base, Rate, Delta, dRate, dDelta = model
+            if n_box is None:
+                n_box = len(Delta)
+                Rates = empty((len(combs), n_box, n_box))
+                Deltas = empty((len(combs), n_box))
+            steps = array([[combs[i_comb][name] - base[name]
+                            for name in parameters] for i_comb in group],
+                          dtype=float).reshape(len(group), len(parameters))
+            Rates[group] = Rate + tensordot(steps, dRate, axes=1)
+            Deltas[group] = Delta + dot(steps, dDelta)
+        return Rates, Deltas
+
+    def state_digest(self, Rate, Delta):
+        """ Return a digest of a rate matrix and initial Delta """
+        digest = sha1(ascontiguousarray(Rate).tobytes())
+        digest.update(ascontiguousarray(Delta).tobytes())
+        return digest.hexdigest()
+
+    def affine_model(self, comb, parameters):
+        """ Return comb, its rate matrix and initial Delta and their
+        derivatives with respect to the given parameters, (param, box, box)
+        and (param, box), which are exact if they depend affinely on the
+        parameters """
+        logger.info('Computing the affine model of %s around\n%s',
+                    ', '.join(parameters), pformat(comb))
+        Rate, Delta = self.comb_state(comb)
+        dRate = empty((len(parameters),) + Rate.shape)
+        dDelta = empty((len(parameters),) + Delta.shape)
+        for i_param, name in enumerate(parameters):
+            step = self._affine_step(comb[name])
+            step_comb = dict(comb)
+            step_comb[name] = comb[name] + step
+            step_Rate, step_Delta = self.comb_state(step_comb)
+            dRate[i_param] = (step_Rate - Rate) / step
+            dDelta[i_param] = (step_Delta - Delta) / step
+        return comb, Rate, Delta, dRate, dDelta
+
+    def detect_affine(self, combs, rtol=1e-9):
+        """ Return the numerical parameters of the combinations on which
+        the rate matrix and the initial Delta depend affinely, without
+        cross terms between them, checked around the first combination
+
+        When two parameters are each affine but multiply each other (e.g. a
+        flux and its partition coefficient), the one with more values in
+        combs is kept. """
+        comb = combs[0]
+
+        def shifted(shifts):
+            """ Rate matrix and initial Delta of comb shifted by a number
+            of steps along some parameters, as a single vector """
+            shifted_comb = dict(comb)
+            for name, n_step in shifts:
+                shifted_comb[name] = comb[name] + \
+                    n_step * self._affine_step(comb[name])
+            return concatenate([values.ravel() for values in
+                                self.comb_state(shifted_comb)])
+
+        def is_zero(diff, *states):
+            return (absolute(diff) <=
+                    rtol * sum(absolute(values) for values in states)).all()
+
+        base = shifted([])
+        candidates = {}
+        for name, value in comb.iteritems():
+            if not isinstance(value, Number) or isinstance(value, bool):
+                continue
+            once, twice = shifted([(name, 1)]), shifted([(name, 2)])
+            if is_zero(twice - 2 * once + base, twice, once, once, base):
+                candidates[name] = once
+        parameters = []
+        for name in sorted(candidates, key=lambda name:
+                           (-len(set(comb[name] for comb in combs)), name)):
+            if all(is_zero(shifted([(name, 1), (other, 1)]) -
+                           candidates[name] - candidates[other] + base,
+                           candidates[name], candidates[other], base)
+                   for other in parameters):
+                parameters.append(name)
+        logger.info('Rate matrix and initial Delta are affine in %s',
+                    ', '.join(parameters) if parameters else 'no parameter')
+        return sorted(parameters)
+
+    def _affine_step(self, value):
+        """ Finite step used to probe a parameter """
+        return abs(value) if value != 0 else 1e0
+
+    def compute_batch(self, combs, time=None):
+        """ Solve the model for a list of sweep combinations at once, with
+        stacked linear algebra instead of one solve per combination
+
+        Return the Delta cube indexed by combination: (comb, box) final
+        Delta, or (comb, time, box) if output time is given. Both the
+        'odeint' and 'analytic' solvers use the stacked matrix exponential,
+        'steady' returns the steady state and ignores time."""
+        self.check_set_combination()
+        logger.info(style.log_header('Computing batch') + ' of %s '
+                    'combinations', style.emph(len(combs)))
+        Rates, Deltas = self.rate_matrices(combs)
+        Ratios = (Deltas / 1e3 + 1e0) * self.standard
+        if self.solver == 'steady':
+            Ratio = self.steady_ratio(Rates, Ratios)
+        elif time is None:
+            Ratio = self.evol_batch(Rates, Ratios,
+                                    self.time[[0, -1]])[:, -1]
+        else:
+            Ratio = self.evol_batch(Rates, Ratios, time)
+        return ((Ratio / self.standard) - 1.0) * 1000
+
+    def evol_batch(self, Rates, Ratios, time):
+        """ Exact solution of the linear system for a stack of rate matrices
+        (comb, box, box) and initial ratios (comb, box) at time[0], returned
+        as a (comb, time, box) array """
+        Ratio = empty((len(Rates), len(time), Ratios.shape[1]))
+        Ratio[:, 0] = Ratios
+        props = {}
+        for k, step in enumerate(diff(time)):
+            if step not in props:
+                props[step] = batch_expm(Rates * step)
+            Ratio[:, k + 1] = einsum('cij,cj->ci', props[step], Ratio[:, k])
+        return Ratio
+
+    def monte_carlo(self, n_real, batch_size=1000, n_workers=None,
+                    seed=None, quantiles=(0.05, 0.5, 0.95)):
+        """ Propagate the uncertainties of self.uncertainties to the final
+        Delta of the boxes, with n_real realizations around the current
+        model, and return their RunningStats
+
+        Realizations are drawn and solved by batches of batch_size, with
+        the stacked solvers of compute_batch, or one sparse solve per
+        realization if self.sparse is set, on n_workers processes (default
+        self.n_workers). Batch i_batch draws from its own random
+        state seeded with (seed, i_batch) and batches are added to the
+        statistics in order, so that results only depend on seed (drawn and
+        logged if None) and not on the number of processes. At most two
+        batches per process are held in memory. """
+        if n_workers is None:
+            n_workers = self.n_workers
+        if seed is None:
+            seed = RandomState().randint(2 ** 31)
+        self.compile_arrays()
+        n_batch = (n_real - 1) // batch_size + 1
+        logger.info(style.log_header('Monte Carlo') + ' %s realizations of '
+                    '%s uncertain entries, seed %s',
+                    style.emph(n_real), len(self.uncertainties),
+                    style.emph(seed))
+        batches = [(seed, i_batch, min(batch_size,
+                                       n_real - i_batch * batch_size))
+                   for i_batch in range(n_batch)]
+        stats = RunningStats(quantiles)
+        if n_workers == 1:
+            for args in batches:
+                stats.add(self.monte_carlo_batch(*args))
+        else:
+            global _sweep_engine
+            _sweep_engine = self
+            pool = Pool(n_workers)
+            try:
+                running = []
+                for args in batches:
+                    running.append(pool.apply_async(_monte_carlo_batch,
+                                                    (args,)))
+                    if len(running) >= 2 * n_workers:
+                        stats.add(running.pop(0).get())
+                for result in running:
+                    stats.add(result.get())
+            finally:
+                pool.terminate()
+                pool.join()
+                _sweep_engine = None
+        stats.boxes = self.network.boxes
+        logger.info('Monte Carlo final Delta\n' + ''.ljust(8) +
+                    ''.join([style.emph(box.rjust(12))
+                             for box in stats.boxes]) +
+                    style.object_repr('\n' + 'mean'.ljust(8)) +
+                    ''.join(['%12.5g' % mean for mean in stats.mean]) +
+                    style.object_repr('\n' + 'std'.ljust(8)) +
+                    ''.join(['%12.5g' % std for std in stats.std]))
+        if self.results_backend == 'text':
+            self.write_monte_carlo(stats)
+        return stats
+
+    def monte_carlo_batch(self, seed, i_batch, size):
+        """ Draw and solve a batch of realizations, return their final
+        Delta (realization, box) """
+        network = self.network
+        rng = RandomState([seed, i_batch])
+        if network.sparse:
+            return self._monte_carlo_sparse(rng, size)
+        n_box = len(network)
+        values = {'Flux': network.flux[None].repeat(size, axis=0),
+                  'Partcoeff': network.partcoeff[None].repeat(size, axis=0)}
+        for kind, box_from, box_to in sorted(self.uncertainties):
+            distribution = self.uncertainties[(kind, box_from, box_to)]
+            values[kind][:, network.index[box_from],
+                         network.index[box_to]] = \
+                getattr(rng, distribution[0])(*distribution[1:], size=size)
+        exchange = values['Flux'] * values['Partcoeff']
+        Rates = exchange.transpose(0, 2, 1)
+        diagonal = range(n_box)
+        Rates[:, diagonal, diagonal] -= exchange.sum(axis=2)
+        Rates /= network.mass[None, :, None]
+        Ratios = ((network.delta / 1e3 + 1e0) *
+                  self.standard)[None].repeat(size, axis=0)
+        if self.solver == 'steady':
+            Ratio = self.steady_ratio(Rates, Ratios)
+        else:
+            Ratio = self.evol_batch(Rates, Ratios, self.time[[0, -1]])[:, -1]
+        return ((Ratio / self.standard) - 1.0) * 1000
+
+    def _monte_carlo_sparse(self, rng, size):
+        """ monte_carlo_batch of a sparse network: the rate matrix of each
+        realization is built and solved as a sparse matrix on the non zero
+        and uncertain flux, without (box, box) arrays. The draws are the
+        ones of a dense network. """
+        network = self.network
+        pairs = sorted(set([(box_from, box_to) for box_from, box_to, _
+                            in network.edges()] +
+                           [(box_from, box_to) for _, box_from, box_to
+                            in self.uncertainties]))
+        position = dict((pair, k) for k, pair in enumerate(pairs))
+        values = {'Flux': array([[network.get_flux(*pair)
+                                  for pair in pairs]]).repeat(size, axis=0),
+                  'Partcoeff': array([[network.get_partcoeff(*pair)
+                                       for pair in pairs]]).repeat(size,
+                                                                   axis=0)}
+        for kind, box_from, box_to in sorted(self.uncertainties):
+            distribution = self.uncertainties[(kind, box_from, box_to)]
+            values[kind][:, position[(box_from, box_to)]] = \
+                getattr(rng, distribution[0])(*distribution[1:], size=size)
+        exchange = values['Flux'] * values['Partcoeff']
+        i_from = array([network.index[box_from] for box_from, _ in pairs],
+                       dtype=int)
+        i_to = array([network.index[box_to] for _, box_to in pairs],
+                     dtype=int)
+        # influx of the boxes to and outflux of the boxes from
+        rows = concatenate((i_to, i_from))
+        cols = concatenate((i_from, i_from))
+        scale = concatenate((1e0 / network.mass[i_to],
+                             -1e0 / network.mass[i_from]))
+        ratio = (network.delta / 1e3 + 1e0) * self.standard
+        span = self.time[-1] - self.time[0]
+        Ratio = empty((size, len(network)))
+        for i_real in range(size):
+            Rate = csc_matrix((concatenate((exchange[i_real],
+                                            exchange[i_real])) * scale,
+                               (rows, cols)), shape=(len(network),) * 2)
+            if self.solver == 'steady':
+                Ratio[i_real] = self.sparse_steady_ratio(Rate, ratio)
+            else:
+                Ratio[i_real] = expm_multiply(Rate * span, ratio)
+        return ((Ratio / self.standard) - 1.0) * 1000
+
+    def write_monte_carlo(self, stats, outdir=None):
+        """ Write the statistics of monte_carlo in Delta.montecarlo """
+        if outdir is None:
+            outdir = self.result_dir
+        f = open(outdir + '/Delta.montecarlo', 'w')
+        f.write(' '.join(['box', 'count', 'mean', 'std', 'min', 'max'] +
+                         ['q%g' % prob for prob in stats.probs]) + '\n')
+        quantiles = stats.quantiles()
+        for i_box, box in enumerate(stats.boxes):
+            f.write(' '.join([box, str(stats.count)] +
+                             [str(values[i_box]) for values in
+                              [stats.mean, stats.std, stats.min,
+                               stats.max]] +
+                             [str(value) for value in quantiles[:, i_box]])
+                    + '\n')
+        f.close()
+
+    def sensitivity_parameters(self):
+        """ Return all the parameters of the network sensitivity can be
+        computed for: ('Flux', box_from, box_to) and ('Partcoeff', box_from,
+        box_to) of the non zero flux, ('Mass', box) and ('Delta', box) """
+        edges = [(box_from, box_to) for box_from, box_to, _
+                 in self.network.edges()]
+        return [('Flux',) + edge for edge in edges] + \
+            [('Partcoeff',) + edge for edge in edges] + \
+            [('Mass', box) for box in self.network.boxes] + \
+            [('Delta', box) for box in self.network.boxes]
+
+    def rate_derivatives(self, parameters):
+        """ Return the derivatives of the dense rate matrix
+        (param, box, box) and of the initial ratio (param, box) with respect
+        to the given parameters """
+        network = self.network
+        Rate = self._Rate.toarray() if issparse(self._Rate) else self._Rate
+        dRate = zeros((len(parameters),) + Rate.shape)
+        dRatio = zeros((len(parameters), len(network)))
+        for i_param, parameter in enumerate(parameters):
+            kind = parameter[0]
+            if kind in ['Flux', 'Partcoeff']:
+                i = network.index[parameter[1]]
+                j = network.index[parameter[2]]
+                # derivative of the exchange Flux * Partcoeff
+                exchange = network.get_partcoeff(*parameter[1:]) \
+                    if kind == 'Flux' else network.get_flux(*parameter[1:])
+                dRate[i_param, j, i] += exchange / network.mass[j]
+                dRate[i_param, i, i] -= exchange / network.mass[i]
+            elif kind == 'Mass':
+                j = network.index[parameter[1]]
+                dRate[i_param, j] = -Rate[j] / network.mass[j]
+            elif kind == 'Delta':
+                dRatio[i_param, network.index[parameter[1]]] = \
+                    self.standard / 1e3
+            else:
+                raise ValueError('Unknown parameter ' + str(parameter))
+        return dRate, dRatio
+
+    def sensitivity(self, parameters=None, time=None, method='adjoint',
+                    outdir=None):
+        """ Compute the derivatives of the boxes Delta of the current model
+        with respect to parameters (default sensitivity_parameters), and
+        return the parameters and the jacobian
+
+        Without time, the jacobian (param, box) is the one of the final
+        Delta, or of the steady state if self.solver is 'steady'. With
+        method 'adjoint', one Frechet derivative of the matrix exponential
+        is computed per box, 'forward' computes one per parameter: use the
+        one with the fewer of them. With output time, the jacobian (param,
+        time, box) of the evolution is computed forward on the grid. """
+        self.compile_arrays()
+        if parameters is None:
+            parameters = self.sensitivity_parameters()
+        logger.info(style.log_header('Computing sensitivity') + ' to %s '
+                    'parameters', style.emph(len(parameters)))
+        _, jacobian = self.compute_sensitivity(parameters, time, method)
+        if self.results_backend == 'text' and jacobian.ndim == 2:
+            self.write_sensitivity(parameters, jacobian, outdir)
+        return parameters, jacobian
+
+    def compute_sensitivity(self, parameters, time=None, method='adjoint'):
+        """ Return the final Delta of the compiled model, or its Delta on
+        time, and its jacobian, see sensitivity """
+        Rate = self._Rate.toarray() if issparse(self._Rate) else self._Rate
+        dRate, dRatio = self.rate_derivatives(parameters)
+        Ratio = (self.network.delta / 1e3 + 1e0) * self.standard
+        if self.solver == 'steady':
+            Ratio, jacobian = self.steady_sensitivity(Rate, Ratio, dRate,
+                                                      dRatio)
+        elif time is not None:
+            Ratio, jacobian = self.evol_sensitivity(
+                Rate, Ratio, dRate, dRatio, self.get_output_time(time))
+        else:
+            span = self.time[-1] - self.time[0]
+            prop = expm(Rate * span)
+            jacobian = dot(dRatio, prop.T)
+            if method == 'adjoint':
+                for i_box in range(len(Ratio)):
+                    unit = zeros(Rate.shape)
+                    unit[i_box] = Ratio
+                    adjoint = expm_frechet(Rate.T * span, unit,
+                                           compute_expm=False)
+                    jacobian[:, i_box] += span * einsum('ij,pij->p', adjoint,
+                                                        dRate)
+            elif method == 'forward':
+                for i_param in range(len(parameters)):
+                    jacobian[i_param] += dot(
+                        expm_frechet(Rate * span, dRate[i_param] * span,
+                                     compute_expm=False), Ratio)
+            else:
+                raise ValueError('Unknown sensitivity method ' + method)
+            Ratio = dot(prop, Ratio)
+        return ((Ratio / self.standard) - 1.0) * 1000, \
+            jacobian * 1e3 / self.standard
+
+    def steady_sensitivity(self, Rate, Ratio, dRate, dRatio):
+        """ Steady state ratio and its derivatives (param, box),
+        differentiating Rate[R][R] . ratio[R] = -Rate[R][S] . ratio[S] for
+        the reservoirs R and the sources S """
+        sources, sinks, reservoirs = self.box_roles(Rate)
+        steady = Ratio.copy()
+        lu = lu_factor(Rate[ix_(reservoirs, reservoirs)])
+        steady[reservoirs] = lu_solve(lu, -dot(Rate[ix_(reservoirs,
+                                                        sources)],
+                                               Ratio[sources]))
+        # d(Rate . ratio) = 0 on the reservoirs
+        rhs = einsum('pij,j->pi', dRate[:, reservoirs][:, :, sources +
+                                                       reservoirs],
+                     steady[sources + reservoirs]) + \
+            dot(dRatio[:, sources], Rate[ix_(reservoirs, sources)].T)
+        jacobian = zeros(dRatio.shape)
+        jacobian[:, sources] = dRatio[:, sources]
+        jacobian[:, reservoirs] = -lu_solve(lu, rhs.T).T
+        jacobian[:, sinks] = nan
+        steady[sinks] = nan
+        return steady, jacobian
+
+    def evol_sensitivity(self, Rate, Ratio, dRate, dRatio, time):
+        """ Ratio (time, box) and its forward derivatives (param, time,
+        box) on the output time, given the ratio at self.time[0]: over a
+        step h, the derivatives are propagated by expm(Rate h) and receive
+        the Frechet derivative of expm(Rate h) along dRate h applied to the
+        ratio """
+        solve_time = time if time[0] == self.time[0] else \
+            concatenate(([self.time[0]], time))
+        jacobian = empty((len(dRate), len(solve_time), len(Ratio)))
+        jacobian[:, 0] = dRatio
+        Ratios = empty((len(solve_time), len(Ratio)))
+        Ratios[0] = Ratio
+        props = {}
+        for k, step in enumerate(diff(solve_time)):
+            if step not in props:
+                props[step] = (expm(Rate * step),
+                               array([expm_frechet(Rate * step, dR * step,
+                                                   compute_expm=False)
+                                      for dR in dRate]))
+            prop, frechet = props[step]
+            jacobian[:, k + 1] = dot(jacobian[:, k], prop.T) + \
+                einsum('pij,j->pi', frechet, Ratios[k])
+            Ratios[k + 1] = dot(prop, Ratios[k])
+        start = len(solve_time) - len(time)
+        return Ratios[start:], jacobian[:, start:]
+
+    def write_sensitivity(self, parameters, jacobian, outdir=None):
+        """ Write the jacobian of the final Delta in Delta.sensitivity, one
+        line per parameter """
+        if outdir is None:
+            outdir = self.result_dir
+        f = open(outdir + '/Delta.sensitivity', 'w')
+        f.write(' '.join(['parameter'] + self.network.boxes) + '\n')
+        for parameter, values in zip(parameters, jacobian):
+            f.write(' '.join([':'.join(parameter)] +
+                             [str(value) for value in values]) + '\n')
+        f.close()
+
+    def compute_final_delta(self, Delta, outdir=None):
+        """ Return the boxes final Delta, from the evolution computed by
+        compute_evolution or directly from compute_steady_state when
+        self.solver is 'steady' """
+        if self.solver == 'steady':
+            return self.compute_steady_state(Delta)
+        self.compute_evolution(Delta, outdir=outdir)
+        return self.Delta_final
+
+    @profiled('final_state')
     def final_state(self, Delta_final, outdir=None):
         """ """
         if outdir is None:
             outdir = self.result_dir
         logger.info(style.log_header('Final boxes state\n',) + ''.ljust(8) +
                     ''.join([style.emph(box.rjust(10))
-                            for box in self.Boxes.iterkeys()]) +
+                            for box in self.network.boxes]) +
                     style.objec_repr('\n' + 'Delta'.ljust(8)) +
                     ''.join([str(round(delta, 7)).rjust(10)
                             for delta in Delta_final
                             if absolute(delta) < 1000]))
-        self.plot_state(self.Boxes.keys(), Delta_final,
-                        name='_final', outdir=outdir)
-        f = open(outdir + '/Delta.final', 'w')
-        for box in self.Boxes.iterkeys():
-            idx = self.Boxes.keys().index(box)
-            f.write(box + ' ' + str(Delta_final[idx]) + '\n')
-        f.close()
+        if self.plot_mode == 'on':
+            self.plot_state(self.network.boxes, Delta_final,
+                            name='_final', outdir=outdir)
+        if self.results_backend == 'text':
+            f = open(outdir + '/Delta.final', 'w')
+            for box, delta in zip(self.network.boxes, Delta_final):
+                f.write(box + ' ' + str(delta) + '\n')
+            f.close()
 
     def init_plots(self):
         """ Define the colors and shape of the model boxes"""
@@ -132,59 +1711,101 @@ class IsotopicBoxModel(Engine):
             "bone":   {'color': "#C9C985", 'shape': "o"}
             }
         self.color_chars = '0123456789ABCDEF'
+        # cached state figures, see plot_state
+        self._state_plots = {}
 
+    @profiled('plot_state')
     def plot_state(self, boxes, deltas, name='', outdir=None):
-        """ Make a graph of a given state """
-        gr = nx.MultiDiGraph()
-        i_box = 0
-        for box in boxes:
-            textcolor = 'white' if sum([self.color_chars.index(col)
-                                        for col in self.plots_conf[box]['color'].split('#')[1]]) < 35 \
-                                else 'black'
-            if box not in gr.nodes():
-                gr.add_node(box, attrib={'delta': round(deltas[i_box], 7)})
-            i_box += 1
+        """ Make a graph of a given state
 
-        for box_from, boxes_to in self.Flux.iteritems():
-            for box_to, flux in boxes_to.iteritems():
-                if flux != 0:
-                    if flux > 0:
-                        #print box_from, box_to
-                        gr.add_edge(box_from, box_to,
-                                    attrib={'flux': flux})
-                    elif flux < 0:
-                        #print box_to, box_from
-                        gr.add_edge(box_to, box_from,
-                                    attrib={'flux': flux})
-        pos = nx.graphviz_layout(gr, prog='neato')
-
-        for p in gr.nodes():
-            nx.draw_networkx_nodes(gr, pos, nodelist=[p],
-                                   node_color=self.plots_conf[p]['color'],
-                                   node_shape=self.plots_conf[p]['shape'])
-#        for f, t, att in gr.edges(data=True):
-#            print f, t, att['flux']
-#        pos = nx.spring_layout(gr)
-#        nx.draw(gr, pos)
-#        nx.draw_networkx_labels(gr, pos)
-        plt.axis('off')
+        The layout and the figure only depend on the boxes and on the
+        direction of the flux, they are cached so that drawing another
+        state of the same network only updates the labels """
+        edges = []
+        for box_from, box_to, flux in self.network.edges():
+            if flux > 0:
+                edges.append((box_from, box_to, flux))
+            else:
+                edges.append((box_to, box_from, flux))
+        topology = (tuple(boxes), tuple(sorted([(box_from, box_to)
+                                               for box_from, box_to, _
+                                               in edges])))
+        if topology not in self._state_plots:
+            self._state_plots[topology] = self._draw_state(boxes, edges)
+        fig, node_labels, edge_labels = self._state_plots[topology]
+        for box, delta in zip(boxes, deltas):
+            node_labels[box].set_text(box + '\n' + "%.7f" % round(delta, 7))
+        for box_from, box_to, flux in edges:
+            edge_labels[(box_from, box_to)].set_text("%g" % flux)
         if outdir is None:
             outdir = self.result_dir
 
         outfile = outdir + '/state' + name + '.png'
 
-        plt.savefig(outfile)
-        plt.close()
+        fig.savefig(outfile)
         logger.info('State has been saved to ' + style.emph(outfile))
 
-    def plot_evolution(self, Delta, outdir=None):
-        """ Draw a graph of the boxes evolution through years"""
+    def _draw_state(self, boxes, edges):
+        """ Compute the layout of the network and draw the parts of the
+        state graph that do not change, return the figure and its node and
+        edge labels """
+        import networkx as nx
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        gr = nx.MultiDiGraph()
+        gr.add_nodes_from(boxes)
+        gr.add_edges_from([(box_from, box_to)
+                           for box_from, box_to, _ in edges])
+        pos = nx.graphviz_layout(gr, prog='neato')
+
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        nx.draw_networkx_edges(gr, pos, ax=ax, edge_color='grey')
+        node_labels = {}
+        for p in gr.nodes():
+            nx.draw_networkx_nodes(gr, pos, nodelist=[p], ax=ax,
+                                   node_color=self.plots_conf[p]['color'],
+                                   node_shape=self.plots_conf[p]['shape'])
+            color = self.plots_conf[p]['color'].split('#')[1]
+            textcolor = 'white' if sum([self.color_chars.index(col)
+                                        for col in color]) < 35 \
+                else 'black'
+            node_labels[p] = ax.text(pos[p][0], pos[p][1], '', fontsize=7,
+                                     color=textcolor, ha='center',
+                                     va='center')
+        edge_labels = {}
+        for box_from, box_to, _ in edges:
+            # a third of the way, so that opposite flux do not overlap
+            x = (2 * pos[box_from][0] + pos[box_to][0]) / 3.
+            y = (2 * pos[box_from][1] + pos[box_to][1]) / 3.
+            edge_labels[(box_from, box_to)] = ax.text(x, y, '', fontsize=6,
+                                                      ha='center',
+                                                      va='center')
+        ax.axis('off')
+        return fig, node_labels, edge_labels
+
+    @profiled('plot_evolution')
+    def plot_evolution(self, Delta, outdir=None, time=None, boxes=None):
+        """ Draw a graph of the boxes evolution through years, Delta being
+        given on time (default self.time) for boxes (default all)
+
+        At most about 10000 times are drawn, so that a memory mapped
+        evolution is only read at these times """
+        import matplotlib.pyplot as plt
+        import gc
+        if time is None:
+            time = self.time
+        if boxes is None:
+            boxes = self.network.boxes
+        stride = max(1, len(time) // 10000)
         fig = plt.figure()
         i_box = 0
-        for box in self.Boxes:
+        for box in boxes:
             # remove deriving boxes
             if absolute(Delta[0, i_box] - Delta[-1, i_box]) < 1000:
-                plt.plot(self.time / 365., Delta[:, i_box], label=box,
+                plt.plot(time[::stride] / 365., Delta[::stride, i_box],
+                         label=box,
                          color=self.plots_conf[box]['color'])
             i_box += 1
         plt.legend()
@@ -199,52 +1820,244 @@ class IsotopicBoxModel(Engine):
         plt.close()
         gc.collect()
 
-    def peace_flag(self, param1, param2, boxes=None, **kwargs):
-        """ Create a contour plot of the boxes final value as a function of two parameters"""
-        x = self.parameters[param1]
-        y = self.parameters[param2]
-        param1 = param1.lower()
-        param2 = param2.lower()
-        if not boxes:
-            boxes = self.Boxes.keys()
+    def result_cube(self, parameters=None):
+        """ Return the ResultCube of the sweep final Delta, read from the
+        store or from the combinations directories of parameters (default
+        self.parameters) """
+        if self.results_backend == 'store':
+            store = self.store or ResultStore(path.join(self.result_dir,
+                                                        'results.store'))
+            return ResultCube.from_store(store)
+        if parameters is None:
+            parameters = self.parameters
+        return ResultCube.from_directories(self.result_dir,
+                                           sweep(parameters))
 
-        logger.info('Drawing contour plot of ' + ','.join([style.log_header(box) for box in boxes]) +\
-                    ' final Delta for ' + style.emph(param1) + ' and ' + style.emph(param2)+' ...')
-        i_box = [self.Boxes.keys().index(box) for box in boxes]
+    def adaptive_sweep(self, param1, param2, parameters=None, boxes=None,
+                       rtol=0.02, n_coarse=5, n_levels=8, **kwargs):
+        """ Sweep param1 and param2 over their values in parameters
+        (default self.parameters) with an adaptive grid, the other
+        parameters being fixed by kwargs or at their first value, and return
+        the ResultCube of the final Delta of the full grid
 
-        print self.parameters.keys()
-        for d in listdir(self.result_dir):
-            if param1 in d:
-                dir_string = '-'.join([e + '-$' + e for e in d.split('-')[0::2]])
-                break
+        The grid starts with n_coarse values of each parameter. Its cells
+        are split in four while the bilinear interpolation of the parent
+        cell misses the new points by more than rtol of the box range (all
+        boxes by default), or by more than rtol / 10 for the cells that
+        cross one of the n_levels contour levels of a box. Points that are
+        not computed are interpolated in their cell. Each round of new
+        points goes through run_sweeper with the store backend and the
+        sweeps_adaptive directory, so that results are written to
+        results.store and resumed as for a full sweep, and the grid is
+        saved in param1_param2_adaptive.npz in the result directory. """
+        from matplotlib.ticker import MaxNLocator
+        if parameters is None:
+            parameters = self.parameters
+
+        def values(name):
+            """ Sorted values of a parameter """
+            if hasattr(parameters[name], '__iter__'):
+                return sorted(parameters[name])
+            return [parameters[name]]
 
-        for key, value in kwargs.iteritems():
-            dir_string = dir_string.replace("$" + key.lower(),
-                                            str(value).replace('.', '').replace('-', ''))
-
-        Delta = []
-        for yy in y:
-            Delta.append([])
-            for xx in x:
-                infile = dir_string.replace("$" + param1,
-                                            str(xx).replace('.', '').replace('-', ''))
-                infile = infile.replace("$" + param2,
-                                            str(yy).replace('.', '').replace('-', ''))
-                f = open(self.result_dir + '/' + infile + '/Delta.final')
-                for i, line in enumerate(f):
-                    if i in i_box:
-                        vals = line.split(' ')
-                        print vals
-                        Delta[y.index(yy)].append(vals[1].rstrip())
-                f.close()
-        print len(x)
-        print len(y)
-        print len(Delta), len(Delta[0])
-        plt.contourf(x, y, Delta)
-        plt.xlabel(param1)
-        plt.ylabel(param2)
-
-        plt.colorbar(fraction=0.1)
-
-        plt.show()
-        plt.savefig(self.result_dir + '/' + param1 + '_' + param2 + '.png')
+        fixed = {}
+        for name in parameters:
+            if name in [param1, param2]:
+                continue
+            if name in kwargs:
+                fixed[name] = kwargs[name]
+            else:
+                fixed[name] = values(name)[0]
+                logger.warning('%s is not given, using %s', name,
+                               fixed[name])
+        x, y = values(param1), values(param2)
+        # final Delta and combination of the computed points
+        points, combs = {}, {}
+        # final Delta of the combinations read from the store by their
+        # values, the store chunks read so far and the boxes
+        finals, read = {}, {'chunks': 0, 'boxes': None}
+        store = ResultStore(path.join(self.result_dir, 'results.store'))
+
+        def key(comb):
+            """ Parameters and values of a combination, as in the store """
+            return tuple((name, float(comb[name])) for name in sorted(comb))
+
+        def evaluate(new_points):
+            """ Run the combinations of the new points and read their final
+            Delta """
+            new_points = [point for point in new_points
+                          if point not in points]
+            for i, j in new_points:
+                # built by sweep, as the combinations of a full sweep, since
+                # their slug depends on the order of their keys
+                combs[(i, j)] = sweep(dict([(param1, [x[i]]),
+                                            (param2, [y[j]])] +
+                                           [(name, [value]) for name, value
+                                            in fixed.iteritems()]))[0]
+            # the points are read back by their values from the store, the
+            # directories of opposite values having the same slug
+            backend, engine_store = self.results_backend, self.store
+            self.results_backend, self.store = 'store', store
+            try:
+                sweeper = ParamSweeper(path.join(self.result_dir,
+                                                 'sweeps_adaptive'),
+                                       combs.values())
+                self.run_sweeper(sweeper)
+                for chunk in store.chunks(read['chunks']):
+                    read['chunks'] += 1
+                    read['boxes'] = list(chunk['boxes'])
+                    names = [str(name) for name in chunk['param_names']]
+                    finals.update((tuple(zip(names, params)), final)
+                                  for params, final in zip(chunk['params'],
+                                                           chunk['final']))
+                done = sweeper.get_done()
+                for point in new_points:
+                    comb = combs[point]
+                    if key(comb) in finals or comb not in done:
+                        continue
+                    # done by an earlier run whose results are lost
+                    logger.warning('%s is not in %s, computing it again',
+                                   comb, store.filename)
+                    results = self.run_combination(comb)
+                    self.combination_done(sweeper, comb, results)
+                    read['boxes'] = results[0]
+                    finals[key(comb)] = results[2]
+                store.flush()
+            finally:
+                self.results_backend, self.store = backend, engine_store
+            if read['boxes'] is None:
+                raise ValueError('No combination of the adaptive sweep '
+                                 'could be computed')
+            for point in new_points:
+                # failed combination if missing
+                points[point] = finals.get(key(combs[point]),
+                                           full(len(read['boxes']), nan))
+            return read['boxes']
+
+        def bilinear(cell, i, j):
+            """ Interpolation of a point from the corners of a cell """
+            i0, i1, j0, j1 = cell
+            u = (x[i] - x[i0]) / float(x[i1] - x[i0]) if i1 > i0 else 0
+            v = (y[j] - y[j0]) / float(y[j1] - y[j0]) if j1 > j0 else 0
+            return (1 - u) * (1 - v) * points[(i0, j0)] + \
+                u * (1 - v) * points[(i1, j0)] + \
+                (1 - u) * v * points[(i0, j1)] + u * v * points[(i1, j1)]
+
+        coarse_x = sorted(set(linspace(0, len(x) - 1, n_coarse).round()
+                              .astype(int)))
+        coarse_y = sorted(set(linspace(0, len(y) - 1, n_coarse).round()
+                              .astype(int)))
+        all_boxes = evaluate([(i, j) for i in coarse_x for j in coarse_y])
+        i_boxes = [all_boxes.index(box) for box in boxes] if boxes \
+            else range(len(all_boxes))
+        coarse = array([points[(i, j)] for i in coarse_x
+                        for j in coarse_y])[:, i_boxes]
+        low, high = nanmin(coarse, axis=0), nanmax(coarse, axis=0)
+        scale = where(high > low, high - low, 1e0)
+        levels = [MaxNLocator(n_levels).tick_values(low[k], high[k])
+                  if high[k] > low[k] else []
+                  for k in range(len(i_boxes))]
+
+        def crosses(cell):
+            """ True if a contour level lies within the corners values """
+            i0, i1, j0, j1 = cell
+            corners = array([points[(i, j)] for i in (i0, i1)
+                             for j in (j0, j1)])[:, i_boxes]
+            return any(((levels[k] > nanmin(corners[:, k])) &
+                        (levels[k] < nanmax(corners[:, k]))).any()
+                       for k in range(len(i_boxes)))
+
+        leaves = set((coarse_x[a], coarse_x[a + 1], coarse_y[b],
+                      coarse_y[b + 1]) for a in range(len(coarse_x) - 1)
+                     for b in range(len(coarse_y) - 1))
+        active = [cell for cell in leaves
+                  if cell[1] - cell[0] > 1 or cell[3] - cell[2] > 1]
+        while active:
+            split = {}
+            for cell in active:
+                i0, i1, j0, j1 = cell
+                cuts_x = sorted(set([i0, (i0 + i1) // 2, i1]))
+                cuts_y = sorted(set([j0, (j0 + j1) // 2, j1]))
+                split[cell] = ([(i, j) for i in cuts_x for j in cuts_y],
+                               [(cuts_x[a], cuts_x[a + 1], cuts_y[b],
+                                 cuts_y[b + 1])
+                                for a in range(len(cuts_x) - 1)
+                                for b in range(len(cuts_y) - 1)])
+            logger.info('Adaptive sweep: refining %s cells',
+                        style.emph(len(active)))
+            evaluate([point for cell_points, _ in split.values()
+                      for point in cell_points])
+            active = []
+            for cell, (cell_points, children) in split.iteritems():
+                error = max(nanmax(absolute(points[point] -
+                                            bilinear(cell, *point))[i_boxes]
+                                   / scale) for point in cell_points)
+                leaves.remove(cell)
+                leaves.update(children)
+                active += [child for child in children
+                           if (child[1] - child[0] > 1 or
+                               child[3] - child[2] > 1) and
+                           error > (rtol / 10 if crosses(child) else rtol)]
+        final = full((len(x), len(y), len(all_boxes)), nan)
+        computed = zeros((len(x), len(y)), dtype=bool)
+        for (i, j), delta in points.iteritems():
+            final[i, j] = delta
+            computed[i, j] = True
+        for cell in leaves:
+            i0, i1, j0, j1 = cell
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    if not computed[i, j] and isnan(final[i, j]).all():
+                        final[i, j] = bilinear(cell, i, j)
+        logger.info('Adaptive sweep: %s of the %s points have been computed',
+                    style.emph(computed.sum()), style.emph(computed.size))
+        savez(path.join(self.result_dir, param1 + '_' + param2 +
+                        '_adaptive.npz'),
+              x=x, y=y, computed=computed, final=final, boxes=all_boxes,
+              cells=array(sorted(leaves)))
+        if param2 < param1:
+            # cube axes are sorted by parameter name
+            final = final.transpose(1, 0, 2)
+        return ResultCube(sorted([param1, param2]), {param1: x, param2: y},
+                          all_boxes, final)
+
+    def peace_flag(self, param1, param2, boxes=None, cube=None, **kwargs):
+        """ Create a contour plot of the boxes final value as a function of
+        two parameters, the other ones being fixed by kwargs or at their
+        first value, from the results of the sweep or from the given cube
+        (e.g. the one of adaptive_sweep) """
+        import matplotlib.pyplot as plt
+        if cube is None:
+            cube = self.result_cube()
+        for name in cube.names:
+            if name.lower() not in [param.lower() for param in
+                                    [param1, param2] + kwargs.keys()]:
+                kwargs[name] = cube.axes[name][0]
+                logger.warning('%s is not given, using %s', name,
+                               kwargs[name])
+        cube = cube.select(**kwargs)
+        if not boxes:
+            boxes = cube.boxes
+        logger.info('Drawing contour plot of ' +
+                    ','.join([style.log_header(box) for box in boxes]) +
+                    ' final Delta for ' + style.emph(param1) + ' and ' +
+                    style.emph(param2) + ' ...')
+        x = cube.axis(param1)
+        y = cube.axis(param2)
+        transpose = cube.names.index(cube.name(param1)) == 0
+        for box in boxes:
+            Delta = cube.delta(box)
+            if transpose:
+                Delta = Delta.T
+            plt.figure()
+            plt.contourf(x, y, Delta)
+            plt.xlabel(param1)
+            plt.ylabel(param2)
+            plt.title(box)
+            plt.colorbar(fraction=0.1)
+            outfile = self.result_dir + '/' + param1 + '_' + param2 + \
+                '_' + box + '.png'
+            plt.savefig(outfile)
+            plt.close()
+            logger.info('Contour plot has been saved to ' +
+                        style.emph(outfile))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+'''
+An engine that fits the parameters of an isotopic box model to measured
+Delta
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+from os import path, mkdir
+from multiprocessing import Pool
+from traceback import format_exc
+from IsotopicBoxModel import IsotopicBoxModel, logger, style
+import IsotopicBoxModel as engine_module
+from numpy import array, zeros, isnan
+from numpy.random import RandomState
+from scipy.optimize import minimize
+
+
+def _fit_start(args):
+    """ Worker function of calibrate """
+    try:
+        return engine_module._sweep_engine.fit(*args), None
+    except Exception:
+        return None, format_exc()
+
+
+class IsotopicCalibration(IsotopicBoxModel):
+    """Engine that fits the free parameters of a model to the measured
+    Delta of some boxes, by minimizing their chi square with a gradient
+    based optimizer from several starting points
+
+    The derived engines call calibrate in their run method: execo also runs
+    the run method of every ancestor engine, so this one has none."""
+
+    def __init__(self):
+        """Define the measures and the free parameters"""
+        super(IsotopicCalibration, self).__init__()
+        # measured final Delta and their uncertainty, {box: (Delta, sigma)}
+        self.measures = {}
+        # free parameters and their bounds, {('Flux', box_from, box_to):
+        # (low, high)}, see BoxNetwork.get for the parameters
+        self.free_parameters = {}
+        # starting points of the fit, the first one being the model values
+        # and the others drawn uniformly within the bounds
+        self.n_starts = 4
+        self.max_iter = 200
+        self.seed = None
+
+    def calibrate(self, n_starts=None, n_workers=None, seed=None):
+        """ Fit the free parameters from n_starts starting points (default
+        self.n_starts) on n_workers processes (default self.n_workers), set
+        the best fit in self.network and return its parameters, values and
+        chi square
+
+        A start whose fit fails is logged and left out, whatever the
+        number of processes. The convergence trace of each start and the
+        best fit are written in the calibration directory of the result
+        directory. """
+        if n_starts is None:
+            n_starts = self.n_starts
+        if n_workers is None:
+            n_workers = self.n_workers
+        if seed is None:
+            seed = self.seed if self.seed is not None \
+                else RandomState().randint(2 ** 31)
+        self.compile_arrays()
+        parameters = sorted(self.free_parameters)
+        bounds = array([self.free_parameters[parameter]
+                        for parameter in parameters], dtype=float)
+        rng = RandomState(seed)
+        starts = [array([self.network.get(parameter)
+                         for parameter in parameters])]
+        starts += [bounds[:, 0] + rng.uniform(size=len(parameters)) *
+                   (bounds[:, 1] - bounds[:, 0])
+                   for _ in range(n_starts - 1)]
+        logger.info(style.log_header('Calibration') + ' of %s parameters '
+                    'on %s measures from %s starting points, seed %s',
+                    style.emph(len(parameters)),
+                    style.emph(len(self.measures)), style.emph(n_starts),
+                    style.emph(seed))
+        args = [(parameters, start, i_start)
+                for i_start, start in enumerate(starts)]
+        engine_module._sweep_engine = self
+        try:
+            if n_workers == 1:
+                results = map(_fit_start, args)
+            else:
+                pool = Pool(n_workers)
+                try:
+                    results = pool.map(_fit_start, args)
+                finally:
+                    pool.terminate()
+                    pool.join()
+        finally:
+            engine_module._sweep_engine = None
+        fits = []
+        for fit, error in results:
+            if error is None:
+                fits.append(fit)
+            else:
+                logger.error('Calibration start failed\n%s', error)
+        if not fits:
+            raise RuntimeError('All calibration starts failed')
+        outdir = path.join(self.result_dir, 'calibration')
+        if not path.exists(outdir):
+            mkdir(outdir)
+        for fit in fits:
+            self.write_trace(parameters, fit, outdir)
+        best = min(fits, key=lambda fit: fit['chi2'])
+        for parameter, value in zip(parameters, best['values']):
+            self.network.set(parameter, value)
+        self.compile_arrays()
+        self.write_calibration(parameters, best, outdir)
+        logger.info('Best fit from start %s, chi square %s\n%s',
+                    best['start'], style.emph(best['chi2']),
+                    '\n'.join([':'.join(parameter).ljust(30) + str(value)
+                               for parameter, value in
+                               zip(parameters, best['values'])]))
+        return parameters, best['values'], best['chi2']
+
+    def fit(self, parameters, start, i_start=0):
+        """ Minimize the chi square from a starting point, the parameters
+        being scaled to [0, 1] within their bounds, and return the fit as a
+        dict with its start, values, chi2, success, message and trace """
+        bounds = array([self.free_parameters[parameter]
+                        for parameter in parameters], dtype=float)
+        scale = bounds[:, 1] - bounds[:, 0]
+        trace = []
+
+        def misfit(x):
+            chi2, gradient = self.misfit(parameters, bounds[:, 0] + x * scale)
+            trace.append([chi2] + list(bounds[:, 0] + x * scale))
+            return chi2, gradient * scale
+
+        result = minimize(misfit, (start - bounds[:, 0]) / scale, jac=True,
+                          method='L-BFGS-B', bounds=[(0, 1)] * len(start),
+                          options={'maxiter': self.max_iter})
+        logger.info('Start %s: %s after %s evaluations, chi square %s',
+                    i_start, result.message, result.nfev, result.fun)
+        return {'start': i_start,
+                'values': bounds[:, 0] + result.x * scale,
+                'chi2': float(result.fun), 'success': bool(result.success),
+                'message': str(result.message), 'trace': trace}
+
+    def misfit(self, parameters, values):
+        """ Set the parameters of the network to values and return the chi
+        square of the final Delta and its gradient with respect to the
+        values """
+        for parameter, value in zip(parameters, values):
+            self.network.set(parameter, value)
+        self.compile_arrays()
+        # adjoint derivatives cost one Frechet derivative per box
+        method = 'forward' if len(parameters) <= len(self.network) \
+            else 'adjoint'
+        Delta, jacobian = self.compute_sensitivity(parameters,
+                                                   method=method)
+        chi2, gradient = 0e0, zeros(len(parameters))
+        for box, (measure, sigma) in self.measures.iteritems():
+            i_box = self.network.index[box]
+            if isnan(Delta[i_box]):
+                raise ValueError('Box %s has no final Delta' % (box,))
+            residual = (Delta[i_box] - measure) / sigma
+            chi2 += residual ** 2
+            gradient += 2 * residual * jacobian[:, i_box] / sigma
+        return chi2, gradient
+
+    def write_trace(self, parameters, fit, outdir):
+        """ Write the chi square and the values of each evaluation of a
+        fit """
+        f = open(path.join(outdir, 'start_%03d.trace' % fit['start']), 'w')
+        f.write(' '.join(['chi2'] + [':'.join(parameter)
+                                     for parameter in parameters]) + '\n')
+        for values in fit['trace']:
+            f.write(' '.join([str(value) for value in values]) + '\n')
+        f.close()
+
+    def write_calibration(self, parameters, best, outdir):
+        """ Write the values of the best fit and its measured and computed
+        Delta """
+        Delta, _ = self.compute_sensitivity([], method='forward')
+        f = open(path.join(outdir, 'calibration.best'), 'w')
+        f.write('# start %s, chi2 %s, %s\n' % (best['start'], best['chi2'],
+                                              best['message']))
+        for parameter, value in zip(parameters, best['values']):
+            f.write(':'.join(parameter) + ' ' + str(value) + '\n')
+        f.write('# box measure sigma Delta\n')
+        for box, (measure, sigma) in sorted(self.measures.iteritems()):
+            f.write(' '.join([box, str(measure), str(sigma),
+                              str(Delta[self.network.index[box]])]) + '\n')
+        f.close()
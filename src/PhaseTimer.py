@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Wall and CPU time of the phases of an engine, logged as JSON lines
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+import json
+from os import getpid, path
+from time import time
+from resource import getrusage, RUSAGE_SELF
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+
+
+def _cpu_time():
+    """ User and system CPU time of the process """
+    usage = getrusage(RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class PhaseTimer(object):
+    """Accumulate the wall and CPU time of named phases and append them,
+    with any other fields, as one JSON line per record to a log file
+
+    The time of a phase does not include the time of the phases nested in
+    it, so that the phases of a record add up to its whole time. Records
+    are appended under an exclusive lock, several processes can share the
+    same log."""
+
+    def __init__(self, filename):
+        """The log file is created on the first record"""
+        self.filename = filename
+        self.phases = {}
+        self._stack = []
+
+    @contextmanager
+    def phase(self, name, enabled=True):
+        """Time the enclosed block as phase name, do nothing if not
+        enabled"""
+        if not enabled:
+            yield
+            return
+        # wall and CPU time of the nested phases are subtracted
+        self._stack.append([0., 0.])
+        wall, cpu = time(), _cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time() - wall, _cpu_time() - cpu
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1][0] += wall
+                self._stack[-1][1] += cpu
+            totals = self.phases.setdefault(name, {'wall': 0., 'cpu': 0.,
+                                                   'calls': 0})
+            totals['wall'] += wall - nested[0]
+            totals['cpu'] += cpu - nested[1]
+            totals['calls'] += 1
+
+    def record(self, **fields):
+        """Append the phases timed since the last record and the given
+        fields as a JSON line, and start a new record"""
+        fields['phases'] = self.phases
+        fields['pid'] = getpid()
+        line = json.dumps(fields, sort_keys=True, default=str) + '\n'
+        f = open(self.filename, 'a')
+        flock(f, LOCK_EX)
+        try:
+            f.write(line)
+            f.flush()
+        finally:
+            flock(f, LOCK_UN)
+            f.close()
+        self.phases = {}
+
+    def read(self):
+        """Return the records of the log as a list of dicts"""
+        if not path.exists(self.filename):
+            return []
+        f = open(self.filename)
+        try:
+            return [json.loads(line) for line in f if line.strip()]
+        finally:
+            f.close()
+
+    def summary(self):
+        """Return a table of the total and mean wall and CPU time of each
+        phase over the records of the log, and of the solver statistics
+        when they are recorded"""
+        records = self.read()
+        totals = {}
+        solver = {}
+        for record in records:
+            for name, phase in record['phases'].iteritems():
+                total = totals.setdefault(name, {'wall': 0., 'cpu': 0.,
+                                                 'calls': 0})
+                for key in total:
+                    total[key] += phase[key]
+            for key, value in (record.get('solver') or {}).iteritems():
+                if key.startswith('n_'):
+                    solver[key] = solver.get(key, 0) + value
+        wall = sum(total['wall'] for total in totals.itervalues())
+        lines = ['%s%s%s%s%s%s' % ('phase'.ljust(20), 'calls'.rjust(8),
+                                   'wall (s)'.rjust(12), 'cpu (s)'.rjust(12),
+                                   'mean (s)'.rjust(12), 'share'.rjust(8))]
+        for name, total in sorted(totals.iteritems(),
+                                  key=lambda item: -item[1]['wall']):
+            lines.append('%s%8d%12.4g%12.4g%12.4g%7.1f%%' % (
+                name.ljust(20), total['calls'], total['wall'], total['cpu'],
+                total['wall'] / max(total['calls'], 1),
+                100 * total['wall'] / wall if wall else 0))
+        lines.append('%s%8d%12.4g' % ('total'.ljust(20), len(records),
+                                      wall))
+        for key, value in sorted(solver.iteritems()):
+            lines.append('%s%8s%12d' % (key.ljust(20), '', value))
+        return '\n'.join(lines)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+'''
+A cube of the final boxes Delta of a parameter sweep, indexed by the
+sweep parameters
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+from os import path
+from execo_engine import slugify, logger
+from numpy import array, full, nan, isclose, nonzero, ndarray
+
+
+def check_slugs(combs):
+    """Raise ValueError if combinations share a directory, as slugify
+    drops the sign of the values"""
+    slugs = {}
+    for comb in combs:
+        other = slugs.setdefault(slugify(comb), comb)
+        if other != comb:
+            raise ValueError('Combinations %s and %s have the same '
+                             'directory %s' % (other, comb, slugify(comb)))
+
+
+class ResultCube(object):
+    """Final Delta of every combination of a sweep, stored in an array with
+    one axis per sweep parameter (sorted values) and a last axis for the
+    boxes. Missing combinations are nan."""
+
+    def __init__(self, names, axes, boxes, final):
+        """names is the list of parameters, axes the dict of their values,
+        boxes the list of boxes and final the Delta array"""
+        self.names = list(names)
+        self.axes = dict((name, array(axes[name])) for name in self.names)
+        self.boxes = list(boxes)
+        self.final = final
+
+    @classmethod
+    def from_combinations(cls, combs, boxes, finals):
+        """Build the cube from a list of combinations and their final Delta
+        """
+        names = sorted(combs[0].keys())
+        axes = dict((name, sorted(set(comb[name] for comb in combs)))
+                    for name in names)
+        index = dict((name, dict((value, i)
+                                 for i, value in enumerate(axes[name])))
+                     for name in names)
+        final = full([len(axes[name]) for name in names] + [len(boxes)], nan)
+        for comb, delta in zip(combs, finals):
+            final[tuple(index[name][comb[name]] for name in names)] = delta
+        return cls(names, axes, boxes, final)
+
+    @classmethod
+    def from_store(cls, store):
+        """Build the cube from the content of a ResultStore"""
+        results = store.read()
+        if results is None:
+            raise ValueError('Store %s is empty' % (store.filename,))
+        combs = [dict(zip(results['param_names'], params))
+                 for params in results['params']]
+        return cls.from_combinations(combs, results['boxes'],
+                                     results['final'])
+
+    @classmethod
+    def from_directories(cls, result_dir, combs):
+        """Build the cube from the Delta.final files of the combinations
+        directories, missing files are skipped, see check_slugs"""
+        check_slugs(combs)
+        found, boxes, finals = [], None, []
+        for comb in combs:
+            infile = path.join(result_dir, slugify(comb), 'Delta.final')
+            if not path.exists(infile):
+                continue
+            f = open(infile)
+            values = [line.split() for line in f if line.strip()]
+            f.close()
+            if boxes is None:
+                boxes = [box for box, _ in values]
+            values = dict(values)
+            found.append(comb)
+            finals.append([float(values[box]) for box in boxes])
+        if not found:
+            raise ValueError('No Delta.final found in ' + result_dir)
+        logger.debug('%s/%s combinations found in %s', len(found),
+                     len(combs), result_dir)
+        return cls.from_combinations(found, boxes, finals)
+
+    def name(self, name):
+        """Return the parameter matching name, ignoring case"""
+        for param in self.names:
+            if param.lower() == name.lower():
+                return param
+        raise KeyError('Unknown parameter ' + name)
+
+    def axis(self, name):
+        """Return the values of a parameter"""
+        return self.axes[self.name(name)]
+
+    def select(self, **fixed):
+        """Return a sub-cube. Each keyword is a parameter and either a
+        value, which fixes it and removes its axis, a list of values or a
+        slice of values (bounds included)"""
+        names, axes, index = [], {}, []
+        fixed = dict((self.name(name), value)
+                     for name, value in fixed.iteritems())
+        for name in self.names:
+            values = self.axes[name]
+            if name not in fixed:
+                names.append(name)
+                axes[name] = values
+                index.append(slice(None))
+                continue
+            value = fixed[name]
+            if isinstance(value, slice):
+                keep = nonzero(
+                    (values >= (values[0] if value.start is None
+                                else value.start) - 1e-12) &
+                    (values <= (values[-1] if value.stop is None
+                                else value.stop) + 1e-12))[0]
+            elif isinstance(value, (list, tuple, ndarray)):
+                keep = [self._position(name, v) for v in value]
+            else:
+                index.append(self._position(name, value))
+                continue
+            names.append(name)
+            axes[name] = values[keep]
+            index.append(array(keep, dtype=int))
+        final = self.final
+        # apply the indices axis by axis, as numpy would broadcast
+        # several index arrays together
+        axis = 0
+        for idx in index:
+            if isinstance(idx, slice):
+                axis += 1
+            elif isinstance(idx, ndarray):
+                final = final.take(idx, axis=axis)
+                axis += 1
+            else:
+                final = final.take(idx, axis=axis)
+        return ResultCube(names, axes, self.boxes, final)
+
+    def delta(self, box, **fixed):
+        """Return the final Delta of a box as an array with one axis per
+        parameter that is not fixed, see select"""
+        cube = self.select(**fixed) if fixed else self
+        return cube.final[..., self.boxes.index(box)]
+
+    def _position(self, name, value):
+        """Index of a value on the axis of a parameter"""
+        found = nonzero(isclose(self.axes[name], value))[0]
+        if len(found) == 0:
+            raise KeyError('%s has no value %s' % (name, value))
+        return int(found[0])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+'''
+A single file store for the results of a parameter sweep
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+from os import path, makedirs
+from struct import pack, unpack, calcsize
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+from io import BytesIO
+from execo_engine import logger
+from numpy import array, savez_compressed, load, concatenate
+
+_header = '<Q'
+
+
+class ResultStore(object):
+    """Append-only file holding the parameters, initial and final Delta and
+    optionally the trajectory and the time to equilibrium of every
+    combination of a sweep
+
+    Trajectories given as the name of a .npy file, as streamed by
+    compute_evolution, are stored as this name and not copied. Names
+    relative to the directory of the store are read as such.
+
+    Combinations are buffered and written by chunks of chunk_size, each
+    chunk being a compressed npz archive of columns prefixed by its length.
+    Appends hold an exclusive lock on the file, so that several processes
+    can share the same store. Combinations that are still buffered are lost
+    if the process dies: keep the default chunk_size of 1 when the store
+    must stay in sync with a ParamSweeper."""
+
+    def __init__(self, filename, chunk_size=1):
+        """Open the store, the file is created on the first flush"""
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self._chunk = []
+
+    def append(self, comb, slug, boxes, Delta_initial, Delta_final,
+               Delta=None, time=None, equilibrium=None):
+        """Add the results of a combination, comb values must be numbers
+        and Delta an array or the name of a .npy file"""
+        self._chunk.append((comb, slug, boxes, Delta_initial, Delta_final,
+                            Delta, time, equilibrium))
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered combinations as one chunk"""
+        if not self._chunk:
+            return
+        combs, slugs, boxes, initial, final, Delta, time, equilibrium = \
+            zip(*self._chunk)
+        param_names = sorted(combs[0].keys())
+        columns = {'slug': array(slugs),
+                   'param_names': array(param_names),
+                   'params': array([[comb[name] for name in param_names]
+                                    for comb in combs], dtype=float),
+                   'boxes': array(boxes[0]),
+                   'initial': array(initial),
+                   'final': array(final)}
+        if all(isinstance(trajectory, basestring) for trajectory in Delta):
+            columns['trajectory_file'] = array(Delta)
+            columns['time'] = time[0]
+        elif all(trajectory is not None for trajectory in Delta):
+            columns['trajectory'] = array(Delta)
+            columns['time'] = time[0]
+        if all(times is not None for times in equilibrium):
+            columns['equilibrium'] = array(equilibrium)
+        buf = BytesIO()
+        savez_compressed(buf, **columns)
+        data = buf.getvalue()
+        f = open(self.filename, 'ab')
+        flock(f, LOCK_EX)
+        try:
+            f.write(pack(_header, len(data)) + data)
+            f.flush()
+        finally:
+            flock(f, LOCK_UN)
+            f.close()
+        self._chunk = []
+
+    def chunks(self, start=0):
+        """Iterate over the chunks of the store, as dicts of columns, the
+        first start chunks being skipped without being read"""
+        if not path.exists(self.filename):
+            return
+        f = open(self.filename, 'rb')
+        flock(f, LOCK_SH)
+        try:
+            size = calcsize(_header)
+            i_chunk = 0
+            while True:
+                header = f.read(size)
+                if not header:
+                    break
+                if len(header) == size:
+                    length = unpack(_header, header)[0]
+                    if i_chunk < start:
+                        i_chunk += 1
+                        f.seek(length, 1)
+                        continue
+                    data = f.read(length)
+                if len(header) < size or len(data) < length:
+                    logger.warning('Truncated chunk at the end of %s',
+                                   self.filename)
+                    break
+                i_chunk += 1
+                chunk = load(BytesIO(data))
+                yield dict((key, chunk[key]) for key in chunk.files)
+        finally:
+            flock(f, LOCK_UN)
+            f.close()
+
+    def read(self):
+        """Return all the combinations of the store as a dict of columns:
+        slug, param_names, params (comb, param), boxes, initial (comb, box),
+        final (comb, box) and, if every combination has them, time and
+        trajectory (comb, time, box) or trajectory_file (comb), to be read
+        with numpy.load(filename, mmap_mode='r'), and equilibrium
+        (comb, box)"""
+        chunks = list(self.chunks())
+        if not chunks:
+            return None
+        for chunk in chunks[1:]:
+            for key in ['param_names', 'boxes']:
+                if list(chunk[key]) != list(chunks[0][key]):
+                    raise ValueError('Chunks of %s have different %s' %
+                                     (self.filename, key))
+        results = {'param_names': list(chunks[0]['param_names']),
+                   'boxes': list(chunks[0]['boxes'])}
+        for key in ['slug', 'params', 'initial', 'final']:
+            results[key] = concatenate([chunk[key] for chunk in chunks])
+        if all('trajectory' in chunk for chunk in chunks):
+            results['time'] = chunks[0]['time']
+            results['trajectory'] = concatenate([chunk['trajectory']
+                                                 for chunk in chunks])
+        elif all('trajectory_file' in chunk for chunk in chunks):
+            results['time'] = chunks[0]['time']
+            # file names relative to the directory of the store
+            results['trajectory_file'] = array(
+                [path.join(path.dirname(self.filename), filename)
+                 for chunk in chunks
+                 for filename in chunk['trajectory_file']])
+        if all('equilibrium' in chunk for chunk in chunks):
+            results['equilibrium'] = concatenate([chunk['equilibrium']
+                                                  for chunk in chunks])
+        return results
+
+    def export(self, outdir):
+        """Write the Delta.initial, Delta.final and Delta.equilibrium files
+        of every combination in its own directory of outdir, as the text
+        backend does"""
+        results = self.read()
+        if results is None:
+            return
+        for i_comb, slug in enumerate(results['slug']):
+            comb_dir = path.join(outdir, slug)
+            if not path.exists(comb_dir):
+                makedirs(comb_dir)
+            for name, key in [('Delta.initial', 'initial'),
+                              ('Delta.final', 'final'),
+                              ('Delta.equilibrium', 'equilibrium')]:
+                if key not in results:
+                    continue
+                f = open(path.join(comb_dir, name), 'w')
+                for box, delta in zip(results['boxes'],
+                                      results[key][i_comb]):
+                    f.write(box + ' ' + str(delta) + '\n')
+                f.close()
+        logger.info('Store %s has been exported to %s', self.filename,
+                    outdir)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+Statistics of a stream of arrays computed online, in constant memory
+
+See README for details
+
+This tools released under the GNU Public
+License, version 3 or later.
+'''
+from numpy import array, asarray, zeros, ones, full, inf, nan, isnan, \
+    where, sign, sort, percentile, arange, concatenate, minimum, maximum
+
+
+class RunningStats(object):
+    """Count, mean, variance, minimum, maximum and quantiles of each element
+    of a stream of arrays of the same shape, given by batches
+
+    The mean and the variance are merged batch by batch (Chan et al.), the
+    quantiles are estimated with the P-square algorithm (Jain and
+    Chlamtac), which keeps 5 markers per quantile and element whatever the
+    number of samples. Elements that have been nan once stay nan."""
+
+    def __init__(self, quantiles=(0.05, 0.5, 0.95)):
+        """quantiles are fractions between 0 and 1"""
+        self.probs = array(quantiles, dtype=float)
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+        self.min = None
+        self.max = None
+        self._first = []
+
+    def add(self, values):
+        """Add a batch of samples (sample, ...)"""
+        values = asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        if self.mean is None:
+            self.mean = zeros(values.shape[1:])
+            self._m2 = zeros(values.shape[1:])
+            self.min = full(values.shape[1:], inf)
+            self.max = full(values.shape[1:], -inf)
+            self._nan = zeros(values.shape[1:], dtype=bool)
+        n_batch = len(values)
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        total = self.count + n_batch
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * n_batch / total
+        self._m2 = self._m2 + batch_m2 + \
+            delta ** 2 * self.count * n_batch / total
+        self.count = total
+        self.min = minimum(self.min, values.min(axis=0))
+        self.max = maximum(self.max, values.max(axis=0))
+        self._nan |= isnan(values).any(axis=0)
+        # the markers are started with the first 5 samples
+        values = values.reshape(n_batch, -1)
+        while len(values) and len(self._first) < 5:
+            self._first.append(values[0])
+            values = values[1:]
+            if len(self._first) == 5:
+                self._init_markers()
+        for value in values:
+            self._update_markers(value)
+
+    @property
+    def variance(self):
+        """Unbiased variance of the samples"""
+        if self.count < 2:
+            return full(self.mean.shape, nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        """Standard deviation of the samples"""
+        return self.variance ** 0.5
+
+    def quantiles(self):
+        """Return the estimated quantiles, as a (quantile, ...) array"""
+        shape = (len(self.probs),) + self.mean.shape
+        if len(self._first) < 5:
+            # exact quantiles of the few samples
+            first = array(self._first)
+            result = percentile(first, 100 * self.probs, axis=0)
+        else:
+            result = self._heights[:, 2].copy()
+        result = result.reshape(shape)
+        result[:, self._nan] = nan
+        return result
+
+    def _init_markers(self):
+        """Start the markers of each quantile, (quantile, marker, element)
+        """
+        first = sort(array(self._first), axis=0)
+        first = where(isnan(first), 0e0, first)
+        n_prob = len(self.probs)
+        self._heights = first[None].repeat(n_prob, axis=0)
+        self._positions = arange(1e0, 6e0)[None, :, None] * \
+            ones(self._heights.shape)
+        self._desired = concatenate([ones((n_prob, 1)),
+                                     1 + 2 * self.probs[:, None],
+                                     1 + 4 * self.probs[:, None],
+                                     3 + 2 * self.probs[:, None],
+                                     full((n_prob, 1), 5e0)], axis=1)
+        self._increments = concatenate([zeros((n_prob, 1)),
+                                        self.probs[:, None] / 2,
+                                        self.probs[:, None],
+                                        (1 + self.probs[:, None]) / 2,
+                                        ones((n_prob, 1))], axis=1)
+
+    def _update_markers(self, value):
+        """Add one sample to the markers of every quantile and element"""
+        value = where(isnan(value), 0e0, value)[None, :]
+        q, n = self._heights, self._positions
+        q[:, 0] = minimum(q[:, 0], value)
+        q[:, 4] = maximum(q[:, 4], value)
+        # markers above the sample move up by one
+        n[:, 1:] += (value[:, None] < q[:, 1:]) | \
+            (arange(1, 5)[None, :, None] == 4)
+        self._desired += self._increments
+        desired = self._desired[:, :, None]
+        for i in range(1, 4):
+            d = desired[:, i] - n[:, i]
+            move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | \
+                ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+            if not move.any():
+                continue
+            d = sign(d)
+            # piecewise parabolic prediction, linear if not monotonic
+            parabolic = q[:, i] + d / (n[:, i + 1] - n[:, i - 1]) * (
+                (n[:, i] - n[:, i - 1] + d) * (q[:, i + 1] - q[:, i]) /
+                (n[:, i + 1] - n[:, i]) +
+                (n[:, i + 1] - n[:, i] - d) * (q[:, i] - q[:, i - 1]) /
+                (n[:, i] - n[:, i - 1]))
+            q_next = where(d > 0, q[:, i + 1], q[:, i - 1])
+            n_next = where(d > 0, n[:, i + 1], n[:, i - 1])
+            linear = q[:, i] + d * (q_next - q[:, i]) / (n_next - n[:, i])
+            new = where((q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1]),
+                        parabolic, linear)
+            q[:, i] = where(move, new, q[:, i])
+            n[:, i] = where(move, n[:, i] + d, n[:, i])
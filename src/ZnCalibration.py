@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 from IsotopicBoxModel import *
+from IsotopicCalibration import IsotopicCalibration
 
-class ZnCalibration(IsotopicBoxModel):
+class ZnCalibration(IsotopicCalibration):
     """ 
     A simple engine that perform the computation 
     """ 
@@ -14,6 +15,10 @@ class ZnCalibration(IsotopicBoxModel):
     
     def run(self):
         """ Execute the engine and compute the results """        
+        if self.measures:
+            # fit the free parameters first, the evolution is computed
+            # with the best fit
+            self.calibrate()
         Delta = self.initial_state()
         
         Delta = self.compute_evolution(Delta)
@@ -25,9 +30,16 @@ class ZnCalibration(IsotopicBoxModel):
         """ Define the time parameters, the isotopic standard and  the boxes, flux and partition coefficients """
         n_timestep = 1000000
         self.time = linspace(0, 13870.0, n_timestep)  # temps
+        # only keep a few hundred samples of the evolution
+        self.output_time = linspace(0, 13870.0, 500)
          
         # JMC standard
         self.standard = 0.565203
+        # measured Delta {box: (Delta, sigma)} and free parameters
+        # {('Flux', box_from, box_to): (low, high)} to calibrate, e.g.
+        # self.measures = {'RBC': (0.98, 0.05), 'plasma': (0.77, 0.05)}
+        # self.free_parameters = {('Partcoeff', 'plasma', 'RBC'):
+        #                         (0.999, 1.001)}
          
         self.Boxes = { 
             "diet":     {'Delta':    0e0, 'Mass':  1e12}, 
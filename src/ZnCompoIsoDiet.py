@@ -4,7 +4,6 @@ from IsotopicBoxModel import IsotopicBoxModel, sweep, ParamSweeper, slugify, \
     logger, path, mkdir, linspace
 from numpy import arange
 from random import gauss
-from pylab import *
 from execo.log import style
 
 
@@ -29,35 +28,18 @@ class ZnCompoIsoDiet(IsotopicBoxModel):
                       'flux_PB': arange(0.01, 0.1, 0.03)}
         sweeps = sweep(self.parameters)
         sweeper = ParamSweeper(path.join(self.result_dir, "sweeps"), sweeps)
-        logger.info('Engine will treat %s models',
-                    style.emph(len(sweeper.get_remaining())))
-        total_comb = len(sweeper.get_remaining())
-        i_comb = 0
-        while len(sweeper.get_remaining()) > 0:
-            i_comb += 1
-            comb = sweeper.get_next()
-            logger.info(style.comb('Combination %s/%s' % (i_comb, total_comb))
-                        + '\n%s', pformat(comb))
-            comb_dir = self.result_dir + '/' + slugify(comb)
-            try:
-                mkdir(comb_dir)
-            except:
-                pass
-            self.set_boxes(comb['delta_diet'])
-            self.set_flux(comb['flux_DP'], comb['flux_PB'])
-            self.set_partcoeff(comb['coeff_DP'])
-            Delta = []
-            Delta = self.initial_state(outdir=comb_dir)
-            Delta = self.compute_evolution(Delta, outdir=comb_dir)
-            self.final_state(Delta[-1, :], outdir=comb_dir)
-
-            sweeper.done(comb)
-            logger.info('Combination done\n')
-        self.set_boxes(1)
+        self.run_sweeper(sweeper)
         self.peace_flag('delta_diet', 'flux_DP')
         logger.info('All combinations have been done, result can be found in '
                     + self.result_dir)
 
+    def set_combination(self, comb):
+        """Set the boxes, flux and partition coefficients of a sweep
+        combination"""
+        self.set_boxes(comb['delta_diet'])
+        self.set_flux(comb['flux_DP'], comb['flux_PB'])
+        self.set_partcoeff(comb['coeff_DP'])
+
     def set_flux(self, flux_DP, flux_PB):
         """Change value"""
         self.Flux = {
@@ -21,30 +21,16 @@ class ZnDietRatio(IsotopicBoxModel):
 
         sweeps = sweep(parameters)
         sweeper = ParamSweeper(path.join(self.result_dir, "sweeps"), sweeps)
-        total_comb = len(sweeper.get_remaining())
-        i_comb = 1
-        while len(sweeper.get_remaining()) > 0:
-            logger.info(style.comb('Treating combination %s/%s' % 
-                                   (i_comb, total_comb)))
-            comb = sweeper.get_next()
-            comb_dir = self.result_dir + '/' + slugify(comb)
-            try:
-                mkdir(comb_dir)
-            except:
-                pass
-            self.set_flux(comb['flux_diet'], comb['flux_bone'])
-            Delta = []
-            Delta = self.initial_state(outdir=comb_dir)
-            Delta = self.compute_evolution(Delta, outdir=comb_dir)
-            self.final_state(Delta[-1, :], outdir=comb_dir)
-            sweeper.done(comb)
-            logger.info('Combination done\n')
-            i_comb += 1
+        self.run_sweeper(sweeper)
 
 
         logger.info('All combinations have been done, result can be found in '
                     + self.result_dir)
 
+    def set_combination(self, comb):
+        """Set the flux of a sweep combination"""
+        self.set_flux(comb['flux_diet'], comb['flux_bone'])
+
     def set_flux(self, flux_diet, flux_bone):
         k = 0.33
         t = 0.58333
@@ -4,7 +4,6 @@ from IsotopicBoxModel import IsotopicBoxModel, sweep, ParamSweeper, slugify, \
     logger, path, mkdir, linspace, style
 from numpy import arange
 from random import gauss
-from pylab import *
 
 
 class ZnModelB(IsotopicBoxModel):
@@ -28,39 +27,18 @@ class ZnModelB(IsotopicBoxModel):
                       'flux_DP': arange(10, 12, 2)}
         sweeps = sweep(parameters)
         sweeper = ParamSweeper(path.join(self.result_dir, "sweeps"), sweeps)
-        logger.info('Engine will treat %s models',
-                    style.emph(len(sweeper.get_remaining())))
-
-        while len(sweeper.get_remaining()) > 0:
-            comb = sweeper.get_next()
-            logger.info(style.comb(' Performing new combination ') + '\n%s',
-                        pformat(comb))
-            comb_dir = self.result_dir + '/' + slugify(comb)
-            try:
-                mkdir(comb_dir)
-            except:
-                pass
-            self.set_boxes(comb['delta_diet'])
-            self.set_partcoeff(comb['coeff_DP'])
-            self.set_flux(comb['flux_DP'])
-            Delta = []
-            Delta = self.initial_state(outdir=comb_dir)
-            Delta = self.compute_evolution(Delta, outdir=comb_dir)
-            self.final_state(Delta[-1, :], outdir=comb_dir)
-           # levels = [-0.2, -0.1,0,0.1,0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1, 1.0, 1.1, 1.2, 1.3, 1.4, 1.5, 1.6, 1.7]
-           # p1=self.set_contourf(delta_diet,coeff_DP, Delta[-1, 4], levels)
-          #  ylabel(r"coeff_diet$")
-          #  xlabel(r"$delta_D$")
-          #  xlim([0,1])
-            #cbar = colorbar(p1)
-           # cbar.ax.set_ylabel ('d66Zn')
-           # show()
-            sweeper.done(comb)
-            logger.info('Combination done\n')
+        self.run_sweeper(sweeper)
 
         logger.info('All combinations have been done, result can be found in '
                     + self.result_dir)
 
+    def set_combination(self, comb):
+        """Set the boxes, flux and partition coefficients of a sweep
+        combination"""
+        self.set_boxes(comb['delta_diet'])
+        self.set_partcoeff(comb['coeff_DP'])
+        self.set_flux(comb['flux_DP'])
+
     def set_flux(self, flux_DP):
         """Change value"""
         self.Flux = {
@@ -20,32 +20,18 @@ walltime, env_file or env_name, stress, and clusters and initialize the engine "
         self.parameters = {'flux_diet': range(7, 18), 'flux_bone': [0.0029 * i for i in range(1, 28, 1) ]}
         sweeps = sweep(self.parameters)
         sweeper = ParamSweeper( path.join(self.result_dir, "sweeps"), sweeps)
-#        h = hpy()
-#        print h.heap()
-        while len(sweeper.get_remaining()) >0:
-            comb = sweeper.get_next()
-            comb_dir = self.result_dir +'/'+ slugify(comb)
-            try:
-                mkdir(comb_dir)
-            except:
-                pass
-            self.set_flux(comb['flux_diet'], comb['flux_bone'])
-            Delta = []
-            
-            Delta = self.initial_state(outdir = comb_dir)
-            Delta = self.compute_evolution(Delta, outdir = comb_dir)
-            self.final_state(Delta[-1,:], outdir = comb_dir)
-            sweeper.done(comb)
-#            print h.heap()
-            gc.collect()
-            logger.info('Combination done\n')
+        self.run_sweeper(sweeper)
  
         
         logger.info('All combinations have been done, result can be found in '+self.result_dir)
-        self.peace_flag(['RBC'], 'flux_bone', 'flux_diet')
+        self.peace_flag('flux_bone', 'flux_diet', boxes=['RBC'])
         
         
         
+    def set_combination(self, comb):
+        """Set the flux of a sweep combination"""
+        self.set_flux(comb['flux_diet'], comb['flux_bone'])
+
     def set_flux(self, flux_diet, flux_bone):
         k = 0.33
         t = flux_diet/12
@@ -106,39 +92,3 @@ walltime, env_file or env_name, stress, and clusters and initialize the engine "
             "skin": {"diet": 1.0, "plasma": 1e0, "RBC": 1e0, "liver": 1e0, "urine": 1e0, "feces": 1e0, "muscle": 1e0, "bone":1e0, "skin": 1e0, "kidney":1e0},
             "kidney": {"diet": 1.0, "plasma": coeff_KU, "RBC": 1e0, "liver": 1e0, "urine": coeff_KU, "feces": 1e0, "muscle": 1e0, "bone":1e0, "skin": 1e0, "kidney":1e0}
             }
-            
-
-    def peace_flag(self, boxes, param1, param2 ):
-        """ Create a contour plot of the boxes final value as a function of two parameters"""
-        logger.info('Drawing contour plot of '+','.join( [ set_style( box, 'log_header') for box in boxes] )+\
-                    ' final Delta for '+set_style(param1, 'emph')+' and '+set_style(param2, 'emph')+' ...')
-        i_box = [ self.Boxes.keys().index(box) for box in boxes]
-        
-        x = self.parameters[param1]
-        y = self.parameters[param2]
-        
-        Delta = []
-        for yy in y:
-            Delta.append([])
-            for xx in x:    
-                infile = self.result_dir +slugify([param1, xx, param2, yy])+'/Delta.final'
-                
-                f = open(infile)
-                for i, line in enumerate(f):
-                    if i in i_box:
-                        vals = line.split(' ')
-                        Delta[y.index(yy)].append( vals[1].rstrip() )
-                f.close()
-                
-        plt.contourf(x, y, Delta)
-        plt.xlabel(param1)
-        plt.ylabel(param2)
-
-        plt.colorbar(fraction=0.1)
-
-#        plt.show()
-        plt.savefig('test.png')
-
-        
-        
-        
\ No newline at end of file
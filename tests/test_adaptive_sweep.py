@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Adaptive sweep of two parameters, compared to the points computed one by one
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+from os import remove
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import allclose, isnan
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger, ParamSweeper, sweep, path
+from Znturnover import Znturnover
+
+
+class ShiftedTurnover(Znturnover):
+    """ Znturnover with a diet flux shifted by a signed parameter """
+
+    def set_combination(self, comb):
+        self.set_flux(12. + comb['shift'], comb['flux_bone'])
+
+
+class AdaptiveSweepTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self):
+        engine = ShiftedTurnover()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        engine.solver = 'steady'
+        return engine
+
+    def check(self, engine, parameters):
+        cube = engine.adaptive_sweep('shift', 'flux_bone', parameters,
+                                     boxes=['plasma', 'bone'], n_coarse=4)
+        self.assertEqual(engine.results_backend, 'text')
+        self.assertTrue(engine.store is None)
+        for shift in parameters['shift']:
+            for flux_bone in parameters['flux_bone']:
+                engine.set_combination({'shift': shift,
+                                        'flux_bone': flux_bone})
+                Delta = engine.compute_steady_state(engine.initial_state())
+                final = cube.select(shift=shift, flux_bone=flux_bone).final
+                self.assertTrue(allclose(final[~isnan(Delta)],
+                                         Delta[~isnan(Delta)]))
+
+    def test_opposite_values(self):
+        self.check(self.engine(), {'shift': [-1.5, -0.5, 0.5, 1.5],
+                                   'flux_bone': [0.01, 0.03, 0.05]})
+
+    def test_after_text_sweep(self):
+        # the points done by a full sweep are not in the store
+        engine = self.engine()
+        parameters = {'shift': [0.5, 1.5, 2.5, 3.5],
+                      'flux_bone': [0.01, 0.03, 0.05]}
+        engine.run_sweeper(ParamSweeper(path.join(self.result_dir,
+                                                  'sweeps'),
+                                        sweep(parameters)))
+        self.check(engine, parameters)
+
+    def test_lost_store(self):
+        engine = self.engine()
+        parameters = {'shift': [0.5, 1.5, 2.5, 3.5],
+                      'flux_bone': [0.01, 0.03, 0.05]}
+        self.check(engine, parameters)
+        remove(path.join(self.result_dir, 'results.store'))
+        self.check(engine, parameters)
+
+if __name__ == '__main__':
+    unittest.main()
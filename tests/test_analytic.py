@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Analytic evolution with the propagators bounded in memory, compared to the
+one with all of them
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import linspace, concatenate, allclose
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from Znturnover import Znturnover
+
+
+class AnalyticTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.engine = Znturnover()
+        self.engine.result_dir = mkdtemp()
+        self.engine.set_combination({'flux_diet': 12., 'flux_bone': 0.05})
+        self.engine.compile_arrays()
+        self.ratio = (self.engine.network.delta / 1e3 + 1e0) * \
+            self.engine.standard
+
+    def tearDown(self):
+        rmtree(self.engine.result_dir)
+
+    def check(self, time):
+        reference = self.engine.evol_analytic(self.ratio, time)
+        size = 8 * len(self.ratio) ** 2
+        # three powers or propagators, none
+        for memory in [5 * size, size]:
+            self.engine.analytic_memory = memory
+            Ratio = self.engine.evol_analytic(self.ratio, time)
+            self.assertEqual(Ratio.shape, reference.shape)
+            self.assertTrue(allclose(Ratio, reference, rtol=1e-10, atol=0))
+
+    def test_regular(self):
+        self.check(linspace(0, 365., 101))
+
+    def test_irregular(self):
+        self.check(concatenate((linspace(0, 10., 11),
+                                linspace(20., 365., 24))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Batch solve of sweep combinations, compared to the solve of each one
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import allclose, isnan
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger, sweep
+from Znturnover import Znturnover
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.engine = Znturnover()
+        self.engine.result_dir = mkdtemp()
+        self.engine.plot_mode = 'off'
+        self.engine.results_backend = 'none'
+        self.engine.solver = 'steady'
+        self.combs = sweep({'flux_diet': [10., 12.],
+                            'flux_bone': [0.01, 0.03, 0.05]})
+
+    def tearDown(self):
+        rmtree(self.engine.result_dir)
+
+    def check(self):
+        batch = self.engine.compute_batch(self.combs)
+        for comb, final in zip(self.combs, batch):
+            self.engine.set_combination(comb)
+            Delta = self.engine.compute_steady_state(
+                self.engine.initial_state())
+            self.assertTrue(allclose(final[~isnan(Delta)],
+                                     Delta[~isnan(Delta)]))
+
+    def change_model(self):
+        # the dicts are replaced, as compile_network requires
+        Boxes = dict((box, dict(values))
+                     for box, values in self.engine.Boxes.iteritems())
+        Boxes['bone']['Mass'] *= 2
+        Boxes['diet']['Delta'] = 0.5
+        self.engine.Boxes = Boxes
+
+    def test_affine(self):
+        self.engine.affine_parameters = ['flux_bone']
+        self.check()
+        self.change_model()
+        self.check()
+
+    def test_auto(self):
+        self.engine.affine_parameters = 'auto'
+        self.check()
+        self.change_model()
+        self.check()
+
+    def test_not_affine(self):
+        self.check()
+        self.change_model()
+        self.check()
+
+
+if __name__ == '__main__':
+    unittest.main()
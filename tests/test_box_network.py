@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Rate matrix of a BoxNetwork patched entry by entry, compared to the one of
+a network compiled again from the changed dicts
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from numpy import allclose
+from numpy.random import RandomState
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from BoxNetwork import BoxNetwork
+from FeSimple import FeSimple
+
+
+class BoxNetworkTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        model = FeSimple()
+        self.Boxes = dict((box, dict(values))
+                          for box, values in model.Boxes.iteritems())
+        self.Flux = dict((box, dict(values))
+                         for box, values in model.Flux.iteritems())
+        self.Partcoeff = dict((box, dict(values))
+                              for box, values in model.Partcoeff.iteritems())
+
+    def rate(self, network):
+        Rate = network.rate_matrix()
+        return Rate.toarray() if network.sparse else Rate.copy()
+
+    def check(self, network):
+        fresh = BoxNetwork(self.Boxes, self.Flux, self.Partcoeff,
+                           sparse=network.sparse)
+        self.assertEqual(network.boxes, fresh.boxes)
+        self.assertTrue(allclose(self.rate(network), self.rate(fresh),
+                                 rtol=1e-12, atol=0))
+
+    def test_patch(self):
+        boxes = sorted(self.Boxes)
+        for sparse in [False, True]:
+            self.setUp()
+            rng = RandomState(5)
+            network = BoxNetwork(self.Boxes, self.Flux, self.Partcoeff,
+                                 sparse=sparse)
+            network.rate_matrix()
+            for _ in range(200):
+                kind = rng.randint(3)
+                box_from, box_to = [boxes[i]
+                                    for i in rng.randint(len(boxes), size=2)]
+                if kind == 0:
+                    # new, changed and removed flux
+                    flux = rng.choice([0e0, rng.uniform(0, 30)])
+                    network.set_flux(box_from, box_to, flux)
+                    self.Flux[box_from][box_to] = flux
+                elif kind == 1:
+                    partcoeff = rng.uniform(0.999, 1.001)
+                    network.set_partcoeff(box_from, box_to, partcoeff)
+                    self.Partcoeff[box_from][box_to] = partcoeff
+                else:
+                    mass = rng.uniform(1e-2, 1e3)
+                    network.set_mass(box_to, mass)
+                    self.Boxes[box_to]['Mass'] = mass
+                self.check(network)
+
+    def test_update(self):
+        network = BoxNetwork(self.Boxes, self.Flux, self.Partcoeff)
+        network.rate_matrix()
+        self.Flux['plasma']['RBC'] = 30.
+        self.Flux['RBC']['menses'] = 0.2
+        self.Boxes['liver']['Mass'] = 2e3
+        network.update(Boxes=self.Boxes, Flux=self.Flux)
+        self.check(network)
+
+
+if __name__ == '__main__':
+    unittest.main()
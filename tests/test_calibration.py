@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Calibration from several starting points, some of which fail
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import linspace
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from ZnCalibration import ZnCalibration
+
+
+class FailingCalibration(ZnCalibration):
+    """ ZnCalibration whose fit fails from some starting points """
+
+    def __init__(self):
+        super(FailingCalibration, self).__init__()
+        self.failing = []
+
+    def fit(self, parameters, start, i_start=0):
+        if i_start in self.failing:
+            raise ValueError('Start %s failed' % i_start)
+        return super(FailingCalibration, self).fit(parameters, start,
+                                                   i_start)
+
+
+class CalibrationTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.CRITICAL)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self, failing, name):
+        engine = FailingCalibration()
+        engine.result_dir = os.path.join(self.result_dir, name)
+        os.mkdir(engine.result_dir)
+        engine.plot_mode = 'off'
+        engine.time = linspace(0, 13870., 101)
+        engine.output_time = None
+        engine.measures = {'RBC': (0.3, 0.05)}
+        engine.free_parameters = {('Partcoeff', 'plasma', 'RBC'):
+                                  (0.999, 1.001)}
+        engine.n_starts = 3
+        engine.max_iter = 5
+        engine.seed = 1
+        engine.failing = failing
+        return engine
+
+    def test_failed_start(self):
+        for n_workers in [1, 2]:
+            engine = self.engine([1], 'workers_%s' % n_workers)
+            engine.calibrate(n_workers=n_workers)
+            # the other starts are fitted
+            self.assertEqual(sorted(os.listdir(os.path.join(
+                engine.result_dir, 'calibration'))),
+                ['calibration.best', 'start_000.trace', 'start_002.trace'])
+
+    def test_all_failed(self):
+        for n_workers in [1, 2]:
+            engine = self.engine([0, 1, 2], 'workers_%s' % n_workers)
+            self.assertRaises(RuntimeError, engine.calibrate,
+                              n_workers=n_workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Stopping the evolution at equilibrium, compared to a full integration
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import linspace, absolute, isnan
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from Znturnover import Znturnover
+from ZnCalibration import ZnCalibration
+
+
+class EquilibriumTest(unittest.TestCase):
+
+    # muscle and bone need several hundred years to come within it
+    tol = 5e-2
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self, cls):
+        engine = cls()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        engine.results_backend = 'none'
+        engine.time = linspace(0, 2e6, 1001)
+        engine.output_time = None
+        if cls is Znturnover:
+            engine.set_combination({'flux_diet': 12., 'flux_bone': 0.058})
+        return engine
+
+    def check_final(self, cls, solver):
+        engine = self.engine(cls)
+        engine.solver = solver
+        Delta_initial = engine.initial_state(outdir=self.result_dir)
+        full = engine.compute_evolution(Delta_initial.copy())[-1]
+        engine.equilibrium_tol = self.tol
+        stopped = engine.compute_evolution(Delta_initial.copy())[-1]
+        sources, sinks, reservoirs = engine.box_roles(engine._Rate)
+        boxes = [engine.network.boxes[i] for i in reservoirs]
+        # the slow boxes converged, long after the fast ones
+        equilibrium = dict(zip(boxes, engine.equilibrium_time[reservoirs]))
+        self.assertFalse(isnan(engine.equilibrium_time[reservoirs]).any())
+        self.assertGreater(equilibrium['bone'], equilibrium['plasma'])
+        self.assertGreater(equilibrium['muscle'], equilibrium['plasma'])
+        self.assertLess(max(equilibrium.values()), engine.time[-1])
+        self.assertTrue(isnan(engine.equilibrium_time[sources]).all())
+        self.assertTrue(isnan(engine.equilibrium_time[sinks]).all())
+        self.assertLess(absolute(stopped - full)[reservoirs].max(), self.tol)
+        self.assertLess(absolute(stopped - full)[sources].max(), 1e-6)
+        self.assertLess((absolute(stopped - full) /
+                         absolute(full))[sinks].max(), 1e-6)
+
+    def test_znturnover(self):
+        for solver in ['odeint', 'analytic', 'BDF']:
+            self.check_final(Znturnover, solver)
+
+    def test_zncalibration(self):
+        for solver in ['odeint', 'analytic', 'BDF']:
+            self.check_final(ZnCalibration, solver)
+
+    def test_not_converged(self):
+        # within a century, muscle and bone are still far from equilibrium
+        engine = self.engine(ZnCalibration)
+        engine.time = linspace(0, 36500., 1001)
+        engine.equilibrium_tol = self.tol
+        Delta_initial = engine.initial_state(outdir=self.result_dir)
+        engine.compute_evolution(Delta_initial.copy())
+        for box in ['muscle', 'bone']:
+            i = engine.network.boxes.index(box)
+            self.assertTrue(isnan(engine.equilibrium_time[i]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+'''
+Monte Carlo propagation of the uncertainties, on dense and sparse networks
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import allclose, concatenate, percentile, isnan, linspace
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from Znturnover import Znturnover
+
+
+class MonteCarloTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self, sparse, solver):
+        engine = Znturnover()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        engine.results_backend = 'none'
+        engine.sparse = sparse
+        engine.solver = solver
+        # a short evolution, the sparse one is solved per realization
+        engine.time = linspace(0, 30., 11)
+        engine.set_combination({'flux_diet': 12., 'flux_bone': 0.05})
+        engine.uncertainties = {
+            ('Flux', 'diet', 'plasma'): ('uniform', 3., 5.),
+            ('Partcoeff', 'plasma', 'bone'): ('normal', 1.0003, 1e-4),
+            # no flux in the model
+            ('Flux', 'RBC', 'feces'): ('uniform', 0., 0.01)}
+        engine.compile_arrays()
+        return engine
+
+    def test_sparse(self):
+        for solver in ['steady', 'analytic']:
+            dense = self.engine(False, solver).monte_carlo_batch(7, 0, 50)
+            sparse = self.engine(True, solver).monte_carlo_batch(7, 0, 50)
+            self.assertEqual(dense.shape, sparse.shape)
+            self.assertTrue((isnan(dense) == isnan(sparse)).all())
+            self.assertTrue(allclose(dense[~isnan(dense)],
+                                     sparse[~isnan(sparse)]))
+
+    def test_stats(self):
+        for sparse in [False, True]:
+            engine = self.engine(sparse, 'steady')
+            stats = engine.monte_carlo(1000, batch_size=300, seed=3)
+            samples = concatenate([engine.monte_carlo_batch(3, i_batch, size)
+                                   for i_batch, size in
+                                   enumerate([300, 300, 300, 100])])
+            self.assertEqual(stats.count, 1000)
+            # the sinks have no steady state
+            self.assertTrue(allclose(stats.mean, samples.mean(axis=0),
+                                     equal_nan=True))
+            self.assertTrue(allclose(stats.variance,
+                                     samples.var(axis=0, ddof=1),
+                                     equal_nan=True))
+            steady = ~isnan(samples).any(axis=0)
+            exact = percentile(samples[:, steady], [5, 50, 95], axis=0)
+            spread = (exact[-1] - exact[0]).clip(1e-12)
+            self.assertTrue((abs(stats.quantiles()[:, steady] - exact) /
+                             spread < 0.05).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
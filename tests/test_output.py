@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Final Delta of an evolution returned on a shorter output time and in a
+smaller dtype
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import linspace, float32, float64, allclose, isnan
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from Znturnover import Znturnover
+
+
+class OutputTest(unittest.TestCase):
+
+    comb = {'flux_diet': 12., 'flux_bone': 0.05}
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self):
+        engine = Znturnover()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        engine.results_backend = 'none'
+        engine.time = linspace(0, 3650., 101)
+        engine.solver = 'analytic'
+        return engine
+
+    def reference(self):
+        engine = self.engine()
+        engine.set_combination(self.comb)
+        Delta = engine.compute_evolution(engine.initial_state())
+        return Delta[-1]
+
+    def test_final(self):
+        reference = self.reference()
+        for stream in [False, True]:
+            engine = self.engine()
+            # a year of output, in float32
+            engine.output_time = linspace(0, 365., 11)
+            engine.output_dtype = float32
+            engine.stream_evolution = stream
+            boxes, _, Delta_final, _, _ = engine.run_combination(self.comb)
+            self.assertEqual(Delta_final.dtype, float64)
+            # the same evolution, in other steps
+            self.assertTrue(allclose(Delta_final, reference, rtol=1e-9,
+                                     atol=1e-8))
+            Delta = engine.compute_evolution(engine.initial_state())
+            self.assertEqual(Delta.shape, (11, len(boxes)))
+            self.assertEqual(Delta.dtype, float32)
+
+    def test_equilibrium(self):
+        engine = self.engine()
+        engine.output_time = linspace(0, 365., 11)
+        engine.equilibrium_tol = 1e-3
+        engine.set_combination(self.comb)
+        Delta = engine.compute_evolution(engine.initial_state())
+        self.assertEqual(len(Delta), 11)
+        self.assertFalse(isnan(engine.Delta_final).all())
+        self.assertTrue(allclose(engine.Delta_final, self.reference(),
+                                 atol=1e-2))
+
+
+if __name__ == '__main__':
+    unittest.main()
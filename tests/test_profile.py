@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Profile of a sweep run on several workers
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import IsotopicBoxModel, logger, ParamSweeper, \
+    sweep, path
+from PhaseTimer import PhaseTimer
+from Znturnover import Znturnover
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def test_workers(self):
+        engine = Znturnover()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        engine.profile = True
+        engine.n_workers = 2
+        combs = sweep({'flux_diet': [10., 12.], 'flux_bone': [0.01, 0.05]})
+        engine.run_sweeper(ParamSweeper(path.join(self.result_dir, 'sweeps'),
+                                        combs))
+        # execo runs it after the run of the derived engine, this process
+        # has timed nothing
+        IsotopicBoxModel.run(engine)
+        records = PhaseTimer(path.join(self.result_dir,
+                                       'profile.jsonl')).read()
+        slugs = [record['slug'] for record in records
+                 if record['slug'] is not None]
+        self.assertEqual(len(slugs), 4)
+        self.assertEqual(len(set(slugs)), 4)
+        self.assertEqual(engine.timer.filename,
+                         path.join(self.result_dir, 'profile.jsonl'))
+        self.assertIn('solver', engine.timer.summary())
+
+    def test_off(self):
+        # an engine that is not started has no result directory
+        engine = Znturnover()
+        engine.plot_mode = 'off'
+        engine.set_combination({'flux_diet': 12., 'flux_bone': 0.05})
+        Delta_initial = engine.initial_state(outdir=self.result_dir)
+        engine.compute_evolution(Delta_initial, outdir=self.result_dir)
+        self.assertTrue(engine.result_dir is None)
+        self.assertTrue(engine.timer is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
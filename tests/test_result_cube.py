@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Building a ResultCube from the combination directories of a sweep
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from execo_engine import slugify, sweep
+from ResultCube import ResultCube
+
+
+class FromDirectoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def write_final(self, comb, plasma):
+        comb_dir = os.path.join(self.result_dir, slugify(comb))
+        if not os.path.exists(comb_dir):
+            os.mkdir(comb_dir)
+        f = open(os.path.join(comb_dir, 'Delta.final'), 'w')
+        f.write('plasma %s\nbone %s\n' % (plasma, 2 * plasma))
+        f.close()
+
+    def test_read(self):
+        combs = sweep({'flux_diet': [10., 12.], 'flux_bone': [0.5, 1.5]})
+        for i, comb in enumerate(combs):
+            self.write_final(comb, i)
+        cube = ResultCube.from_directories(self.result_dir, combs)
+        self.assertEqual(cube.boxes, ['plasma', 'bone'])
+        for i, comb in enumerate(combs):
+            self.assertEqual(list(cube.select(**comb).final), [i, 2 * i])
+
+    def test_same_slug(self):
+        # the sign is lost in the directory name
+        combs = sweep({'flux_diet': [10.], 'shift': [-0.5, 0.5]})
+        for i, comb in enumerate(combs):
+            self.write_final(comb, i)
+        self.assertRaises(ValueError, ResultCube.from_directories,
+                          self.result_dir, combs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Serial and parallel sweeps of the combinations of a ParamSweeper
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import IsotopicBoxModel, logger, ParamSweeper, sweep, \
+    path
+from Znturnover import Znturnover
+
+
+class FailingTurnover(Znturnover):
+    """ Znturnover failing on one bone flux """
+
+    def set_combination(self, comb):
+        if comb['flux_bone'] == 0.03:
+            raise ValueError('No bone flux of 0.03')
+        super(FailingTurnover, self).set_combination(comb)
+
+
+class NoCombination(IsotopicBoxModel):
+    """ Engine without set_combination """
+
+
+class RunSweeperTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.CRITICAL)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def sweeper(self, name, combs):
+        return ParamSweeper(path.join(self.result_dir, name), combs)
+
+    def test_failure(self):
+        combs = sweep({'flux_diet': [10., 12.],
+                       'flux_bone': [0.01, 0.03, 0.05]})
+        for n_workers in [1, 2]:
+            engine = FailingTurnover()
+            engine.result_dir = self.result_dir
+            engine.plot_mode = 'off'
+            engine.results_backend = 'none'
+            sweeper = self.sweeper('sweeps_%s' % n_workers, combs)
+            self.assertRaises(ValueError, engine.run_sweeper, sweeper,
+                              n_workers)
+            # the failed combination is neither done nor skipped
+            self.assertFalse(any(comb['flux_bone'] == 0.03
+                                 for comb in sweeper.get_done()))
+            self.assertEqual(len(sweeper.get_skipped()), 0)
+
+    def test_workers(self):
+        combs = sweep({'flux_diet': [10., 12.], 'flux_bone': [0.01, 0.05]})
+        finals = []
+        for n_workers in [1, 2]:
+            engine = Znturnover()
+            engine.result_dir = self.result_dir
+            engine.plot_mode = 'off'
+            engine.results_backend = 'store'
+            engine.store = None
+            sweeper = self.sweeper('sweeps_%s' % n_workers, combs)
+            engine.run_sweeper(sweeper, n_workers)
+            self.assertEqual(len(sweeper.get_remaining()), 0)
+            self.assertEqual(len(sweeper.get_done()), len(combs))
+            results = engine.store.read()
+            finals.append(dict((tuple(params), tuple(final)) for
+                               params, final in zip(results['params'][-4:],
+                                                    results['final'][-4:])))
+        self.assertEqual(finals[0], finals[1])
+
+    def test_same_directory(self):
+        # the sign is lost in the directory name
+        combs = sweep({'flux_diet': [10.], 'flux_bone': [-0.05, 0.05]})
+        engine = Znturnover()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        sweeper = self.sweeper('sweeps', combs)
+        self.assertRaises(ValueError, engine.run_sweeper, sweeper)
+        self.assertEqual(len(sweeper.get_remaining()), len(combs))
+        self.assertEqual(os.listdir(self.result_dir), ['sweeps'])
+
+    def test_no_set_combination(self):
+        combs = sweep({'flux_diet': [10.], 'flux_bone': [0.01, 0.05]})
+        engine = NoCombination()
+        engine.result_dir = self.result_dir
+        engine.plot_mode = 'off'
+        sweeper = self.sweeper('sweeps', combs)
+        for run, args in [(engine.run_sweeper, (sweeper, 2)),
+                          (engine.compute_batch, (combs,))]:
+            try:
+                run(*args)
+            except NotImplementedError as error:
+                self.assertIn('NoCombination must define set_combination',
+                              str(error))
+            else:
+                self.fail('NotImplementedError not raised')
+        self.assertEqual(len(sweeper.get_remaining()), len(combs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+Online statistics of a stream of batches, compared to numpy on the whole
+sample
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import unittest
+from numpy import allclose, percentile, isnan, nan, arange
+from numpy.random import RandomState
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from RunningStats import RunningStats
+
+
+class RunningStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = RandomState(42)
+        # (sample, box), of different scales and shapes
+        self.samples = rng.normal(3, 0.5, (20000, 3))
+        self.samples[:, 1] = rng.uniform(-1, 1, 20000)
+        self.samples[:, 2] = rng.lognormal(0, 1, 20000) * 1e3
+
+    def stats(self, batch_sizes, quantiles=(0.05, 0.5, 0.95)):
+        stats = RunningStats(quantiles)
+        start = 0
+        for size in batch_sizes:
+            stats.add(self.samples[start:start + size])
+            start += size
+        return stats, self.samples[:start]
+
+    def test_moments(self):
+        # Chan merge of batches of any size, including one sample
+        for batch_sizes in [[20000], [1000] * 20, [1, 2, 3, 7, 9987, 10000]]:
+            stats, samples = self.stats(batch_sizes)
+            self.assertEqual(stats.count, len(samples))
+            self.assertTrue(allclose(stats.mean, samples.mean(axis=0),
+                                     rtol=1e-12))
+            self.assertTrue(allclose(stats.variance,
+                                     samples.var(axis=0, ddof=1),
+                                     rtol=1e-10))
+            self.assertTrue(allclose(stats.std,
+                                     samples.std(axis=0, ddof=1),
+                                     rtol=1e-10))
+            self.assertTrue((stats.min == samples.min(axis=0)).all())
+            self.assertTrue((stats.max == samples.max(axis=0)).all())
+
+    def test_quantiles(self):
+        probs = (0.05, 0.25, 0.5, 0.75, 0.95)
+        for batch_sizes in [[20000], [3, 997, 19000]]:
+            stats, samples = self.stats(batch_sizes, probs)
+            exact = percentile(samples, [100 * prob for prob in probs],
+                               axis=0)
+            # P-square estimate, within a few percent of the spread
+            spread = exact[-1] - exact[0]
+            self.assertTrue(((abs(stats.quantiles() - exact) /
+                              spread) < 0.02).all())
+
+    def test_few_samples(self):
+        # exact quantiles until the markers are started
+        stats, samples = self.stats([2, 2])
+        self.assertTrue(allclose(stats.quantiles(),
+                                 percentile(samples, [5, 50, 95], axis=0)))
+        # no variance of a single sample
+        stats, _ = self.stats([1])
+        self.assertTrue(isnan(stats.variance).all())
+
+    def test_nan(self):
+        self.samples[arange(0, 20000, 7), 1] = nan
+        stats, _ = self.stats([5000] * 4)
+        self.assertTrue(isnan(stats.mean[1]))
+        self.assertTrue(isnan(stats.quantiles()[:, 1]).all())
+        self.assertFalse(isnan(stats.quantiles()[:, [0, 2]]).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
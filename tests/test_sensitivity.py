@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Adjoint and forward sensitivities of the final Delta, compared to finite
+differences
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from numpy import array, absolute, isnan
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger
+from FeSimple import FeSimple
+
+
+class SensitivityTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.engine = FeSimple()
+        self.engine.result_dir = mkdtemp()
+        self.engine.plot_mode = 'off'
+        self.engine.results_backend = 'none'
+        # the urine of 1e-10 has derivatives of order 1e26, out of reach
+        # of the finite differences
+        Boxes = dict((box, dict(values))
+                     for box, values in self.engine.Boxes.iteritems())
+        Boxes['urine']['Mass'] = 1e1
+        self.engine.Boxes = Boxes
+        self.engine.compile_arrays()
+
+    def tearDown(self):
+        rmtree(self.engine.result_dir)
+
+    def final(self, parameter, value):
+        network = self.engine.network
+        previous = network.get(parameter)
+        network.set(parameter, value)
+        self.engine.compile_arrays()
+        Delta, _ = self.engine.compute_sensitivity([], method='forward')
+        network.set(parameter, previous)
+        self.engine.compile_arrays()
+        return Delta
+
+    def finite_differences(self, parameters):
+        """ Central differences, with a step relative to the value """
+        jacobian = []
+        for parameter in parameters:
+            value = self.engine.network.get(parameter)
+            step = 1e-6 * abs(value) if value != 0 else 1e-6
+            jacobian.append((self.final(parameter, value + step) -
+                             self.final(parameter, value - step)) /
+                            (2 * step))
+        return array(jacobian)
+
+    def check(self, solver):
+        self.engine.solver = solver
+        parameters = self.engine.sensitivity_parameters()
+        expected = self.finite_differences(parameters)
+        for method in ['adjoint', 'forward']:
+            _, jacobian = self.engine.sensitivity(parameters, method=method)
+            self.assertEqual(jacobian.shape, expected.shape)
+            self.assertTrue((isnan(jacobian) == isnan(expected)).all())
+            # relative to the largest derivative of each box, as the
+            # sinks accumulate Delta of order 1e7
+            finite = ~isnan(expected).any(axis=0)
+            error = absolute(jacobian - expected)[:, finite]
+            scale = absolute(expected[:, finite]).max(axis=0)
+            self.assertLess((error / scale).max(), 1e-4)
+
+    def test_final(self):
+        self.check('analytic')
+
+    def test_steady(self):
+        self.check('steady')
+
+
+if __name__ == '__main__':
+    unittest.main()
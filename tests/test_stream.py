@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Evolutions streamed to disk and stored as file names
+
+Run from the repository root with python -m unittest discover tests
+'''
+import os
+import sys
+import logging
+import unittest
+from shutil import rmtree, move
+from tempfile import mkdtemp
+from numpy import load, linspace, allclose
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from IsotopicBoxModel import logger, ParamSweeper, sweep, path
+from ResultStore import ResultStore
+from Znturnover import Znturnover
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        logger.setLevel(logging.ERROR)
+        self.result_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.result_dir)
+
+    def engine(self):
+        engine = Znturnover()
+        engine.result_dir = path.join(self.result_dir, 'run')
+        os.mkdir(engine.result_dir)
+        engine.plot_mode = 'off'
+        engine.time = linspace(0, 3650., 101)
+        engine.stream_evolution = True
+        engine.evolution_chunk = 10
+        return engine
+
+    def test_failed_evolution(self):
+        engine = self.engine()
+        engine.set_combination({'flux_diet': 12., 'flux_bone': 0.05})
+        ratio = (engine.initial_state() / 1e3 + 1) * engine.standard
+
+        def rows():
+            for _ in range(50):
+                yield ratio
+            raise RuntimeError('solver failed')
+
+        self.assertRaises(RuntimeError, engine.collect_evolution, rows(),
+                          ratio, 101, 0, slice(None), float)
+        self.assertFalse(path.exists(path.join(engine.result_dir,
+                                               'evolution.npy')))
+        Delta = engine.collect_evolution(iter([ratio] * 100), ratio, 101,
+                                         0, slice(None), float)
+        self.assertEqual(Delta.shape, (101, ratio.size))
+
+    def test_moved_results(self):
+        engine = self.engine()
+        engine.results_backend = 'store'
+        engine.store_trajectory = True
+        combs = sweep({'flux_diet': [10., 12.], 'flux_bone': [0.05]})
+        engine.run_sweeper(ParamSweeper(path.join(engine.result_dir,
+                                                  'sweeps'), combs))
+        moved = path.join(self.result_dir, 'moved')
+        move(engine.result_dir, moved)
+        results = ResultStore(path.join(moved, 'results.store')).read()
+        for filename, final in zip(results['trajectory_file'],
+                                   results['final']):
+            self.assertTrue(filename.startswith(moved))
+            self.assertTrue(allclose(load(filename, mmap_mode='r')[-1],
+                                     final))
+
+
+if __name__ == '__main__':
+    unittest.main()